@@ -1,14 +1,261 @@
 
 import os
 import time
-import datetime
+import hashlib
+import threading
+import contextlib
+import warnings
+import contextvars
+import collections
+import json
+import netCDF4
 import numpy as np
 #import pandas as pd
 import xarray as xr
 import matplotlib.pyplot as plt
 
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+
+try:
+    import numba
+except ImportError:  # optional, pure numpy engine is used when missing
+    numba = None
+
 # from statsmodels.tsa.seasonal import STL as stl
 
+# max num of harmonic design matrices kept in memory
+HARM_CACHE_SIZE = 32
+
+# max num and total bytes of training fits (residuals and screened dates) kept in memory,
+# a fit of a full cube beyond the byte budget is not cached at all
+FIT_CACHE_SIZE = 4
+FIT_CACHE_BYTES = 512 * 1024 ** 2
+
+# max num of date indexes (datetime64 and linear days of a cube's dates) kept in memory
+DATE_CACHE_SIZE = 32
+
+# num of pixels per tile sent to each worker when running on multiple cpus
+TILE_SIZE = 10000
+
+# output dtypes, rounded change codes (multiples of the control limit) and
+# the -2222 no data code fit int16, unrounded codes are residuals in data units
+CHNG_DTYPES = {True: 'int16', False: 'int32'}
+HARM_DTYPE = 'float32'
+
+# per-pixel status codes of the status band, pixels not ok are -2222 on all dates
+STATUS_OK = 0
+STATUS_INSUFFICIENT = 1  # too few training dates to fit, or to refit after x-bar screening
+STATUS_SINGULAR = 2  # training design matrix (near) singular
+STATUS_LOW = 3  # no present value above low_thresh
+STATUS_NAN_SD = 4  # no historical SD, e.g., fewer than two kept training dates
+STATUS_ZERO_SD = 5  # historical SD of 0, e.g., constant training values
+STATUS_MEANINGS = 'ok insufficient_data singular_design all_below_low_thresh nan_sd zero_sd'
+
+_harm_cache = collections.OrderedDict()
+_fit_cache = collections.OrderedDict()
+_date_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _hash_array(arr: np.ndarray) -> tuple:
+    """
+    Hashable key for the contents, dtype and shape of a numpy array.
+    :param arr: Numpy Array.
+    :return: Tuple. Digest, dtype and shape.
+    """
+
+    arr = np.ascontiguousarray(arr)
+
+    return hashlib.sha1(arr.tobytes()).hexdigest(), arr.dtype.str, arr.shape
+
+
+def _cache_get(
+        cache: collections.OrderedDict,
+        key: tuple
+):
+    """
+    Gets an item from a least-recently-used cache, marking it as recently
+    used. Returns None on a miss.
+    :param cache: OrderedDict. Cache.
+    :param key: Tuple. Cache key.
+    :return: Cached item or None.
+    """
+
+    with _cache_lock:
+        item = cache.get(key)
+        if item is not None:
+            cache.move_to_end(key)
+
+    return item
+
+
+def _nbytes(item) -> int:
+    """
+    Memory held by a numpy array or a dict of numpy arrays.
+    :param item: Numpy Array or Dict of Numpy Arrays.
+    :return: Int. Num of bytes.
+    """
+
+    if isinstance(item, dict):
+        return sum(_nbytes(v) for v in item.values())
+
+    return getattr(item, 'nbytes', 0)
+
+
+def _cache_put(
+        cache: collections.OrderedDict,
+        key: tuple,
+        item,
+        max_size: int,
+        max_bytes: int = None
+) -> None:
+    """
+    Puts an item in a least-recently-used cache, evicting the least
+    recently used items beyond max_size (and max_bytes). An item larger
+    than max_bytes on its own is not cached.
+    :param cache: OrderedDict. Cache.
+    :param key: Tuple. Cache key.
+    :param item: Item to cache.
+    :param max_size: Int. Max num of items kept.
+    :param max_bytes: Int. Max total bytes of items kept, see _nbytes.
+    Defaults to None, i.e., no limit.
+    :return: None.
+    """
+
+    if max_bytes is not None and _nbytes(item) > max_bytes:
+        return
+
+    with _cache_lock:
+        cache[key] = item
+        while len(cache) > max_size or (max_bytes is not None and _nbytes(cache) > max_bytes):
+            cache.popitem(last=False)
+
+
+def clear_caches() -> None:
+    """
+    Empties the harmonic design matrix, training fit and date index caches.
+    """
+
+    with _cache_lock:
+        _harm_cache.clear()
+        _fit_cache.clear()
+        _date_cache.clear()
+
+
+_profile_report = contextvars.ContextVar('profile_report', default=None)
+
+
+@contextlib.contextmanager
+def profile_stages():
+    """
+    Opt-in profiling of ewmacd. Inside the with block, every stage run by
+    ewmacd, ewmacd_per_cube and ewmacd_per_pixel in this thread adds its
+    wall time and call count to the yielded report, a dict of
+    {stage: {'calls': int, 'seconds': float}} in order of first call.
+    Stages are 'subset', 'fit', 'ewma', 'persistence', 'unpack',
+    'fill_gaps', 'kernel' (compiled ewma to fill_gaps), 'state', 'workers'
+    (all of a multi-process run), 'write' (streamed netcdf output),
+    'summarise' and 'output'. Lazy dask runs are not timed until computed. Usage:
+        with profile_stages() as report:
+            ewmacd(ds, ...)
+        logging.info(report)
+    :return: Dict. Stage timings, filled as stages complete.
+    """
+
+    report = {}
+    token = _profile_report.set(report)
+    try:
+        yield report
+    finally:
+        _profile_report.reset(token)
+
+
+@contextlib.contextmanager
+def _stage(name: str):
+    """
+    Times the with block as stage name when profile_stages is active.
+    :param name: String. Name of stage in report.
+    """
+
+    report = _profile_report.get()
+    if report is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        item = report.setdefault(name, {'calls': 0, 'seconds': 0.0})
+        item['calls'] += 1
+        item['seconds'] += time.perf_counter() - start
+
+
+def _years_doys(times: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Years and doys of datetime64 times, vectorised via datetime64 units
+    rather than per element date objects.
+    :param times: Numpy Array. Datetime64 times.
+    :return: Tuple of Numpy Arrays. Years and doys (1 = Jan 1st).
+    """
+
+    days = np.asarray(times).astype('datetime64[D]')
+    years = days.astype('datetime64[Y]')
+
+    return years.astype('int64') + 1970, (days - years).astype('int64') + 1
+
+
+def _get_date_index(
+        years: np.ndarray,  # year of every date in series
+        doys: np.ndarray  # doy of every date in series
+) -> dict:
+    """
+    Returns the date index of a series' dates from a least-recently-used
+    cache, building it on a miss. Keyed on hashes of the year and doy
+    vectors, so every pixel and parameter run on the same cube shares one
+    index. Holds 'dates' (datetime64[D]) and 'days' (days since 1970-01-01),
+    from which linear days of any period are a subtraction (see
+    _linear_days). Arrays are read-only.
+    :param years: Numpy Array. Years of every date.
+    :param doys: Numpy Array. DOYs of every date.
+    :return: Dict. Date index.
+    """
+
+    key = (_hash_array(years), _hash_array(doys))
+
+    index = _cache_get(_date_cache, key)
+    if index is None:
+        years = np.asarray(years, dtype='int64')
+        doys = np.asarray(doys, dtype='int64')
+
+        dates = (years - 1970).astype('datetime64[Y]').astype('datetime64[D]') + (doys - 1)
+        index = {'dates': dates, 'days': dates.astype('int64')}
+
+        for arr in index.values():
+            arr.setflags(write=False)
+        _cache_put(_date_cache, key, index, DATE_CACHE_SIZE)
+
+    return index
+
+
+def _linear_days(
+        index: dict,  # see _get_date_index
+        start_year: int
+) -> np.ndarray:
+    """
+    Dates in linear form, i.e., days from a starting point instead of day of
+    the year, with Jan 1st of start_year = 1. Same as the cumulative year
+    lengths (ea_year / cu_year) plus doy of the original R code.
+    :param index: Dict. Date index, see _get_date_index.
+    :param start_year: Int. First year of the period.
+    :return: Numpy Array. Linear days.
+    """
+
+    return index['days'] - np.datetime64(f'{int(start_year):04d}-01-01', 'D').astype('int64') + 1
+
+
 def _build_harm_matrix(
         ts_rads: np.ndarray,  # doys as radians in array
         ns: int,  # num of sin harmonics (e.g., 2)
@@ -43,6 +290,360 @@ def _build_harm_matrix(
     return X
 
 
+def _get_harm_matrix(
+        doys: np.ndarray,  # doys of every date in series
+        ns: int,  # num of sin harmonics (e.g., 2)
+        nc: int   # num of cos harmonics (e.g., 2)
+) -> np.ndarray:
+    """
+    Returns the harmonic design matrix for a full vector of DOYs from a
+    least-recently-used cache, building it on a miss. Keyed on a hash of
+    the DOY vector and the harmonic counts, so every pixel (which only
+    slices rows out of it) and every parameter run on the same cube reuse
+    the same sin/cos table. Matrices are returned read-only.
+    :param doys: Numpy Array. DOYs of every date.
+    :param ns: Int. Number of sin harmonics (e.g., 2)
+    :param nc: Int. Number of cos harmonics (e.g., 2)
+    :return: Numpy Array. Harmonic design matrix of (dates, 1 + ns + nc).
+    """
+
+    key = (_hash_array(doys), ns, nc)
+
+    X = _cache_get(_harm_cache, key)
+    if X is None:
+        X = _build_harm_matrix(np.asarray(doys) * 2 * np.pi / 365, ns, nc)
+        X.setflags(write=False)
+        _cache_put(_harm_cache, key, X, HARM_CACHE_SIZE)
+
+    return X
+
+
+def _predict_harm(
+        beta: np.ndarray,  # coefficients of (coefs) or (pixels, coefs)
+        X: np.ndarray  # design matrix of (dates, coefs) or (coefs)
+) -> np.ndarray:
+    """
+    Evaluates the harmonic fit from coefficients and design matrix rows.
+    Summed coefficient by coefficient in a fixed order, rather than via a
+    BLAS product whose summation order depends on array shapes, so a single
+    date, a single pixel and a whole cube all give bit-identical fits.
+    :param beta: Numpy Array. Coefficients of (coefs) or (pixels, coefs).
+    :param X: Numpy Array. Design matrix of (dates, coefs) or one row (coefs).
+    :return: Numpy Array. Fit of (pixels, dates), (pixels), (dates) or scalar.
+    """
+
+    beta = np.asarray(beta)
+    X = np.asarray(X)
+
+    # broadcast coefficients over dates when given a full design matrix
+    if X.ndim == 2:
+        beta = beta[..., None, :]
+
+    harm = beta[..., 0] * X[..., 0]
+    for j in range(1, X.shape[-1]):
+        harm += beta[..., j] * X[..., j]
+
+    return harm
+
+
+def _ewma(
+        y: np.ndarray,  # residuals, dates along last axis
+        lam: float | np.ndarray  # ewma lambda, or lambdas broadcastable to y[..., 0]
+) -> np.ndarray:
+    """
+    Exponentially weighted moving average along the last (dates) axis,
+    initialised with the first residual. Output is preallocated and filled
+    by the recursion in one pass, vectorised over any leading (pixel) axes.
+    :param y: Numpy Array. Residuals of (dates) or (pixels, dates).
+    :param lam: Float or Numpy Array. EWMA lambda, or one lambda per leading
+    row (e.g., of shape (lams, 1) for y of (lams, pixels, dates)).
+    :return: Numpy Array. EWMA values, same shape as y.
+    """
+
+    ewma = np.empty_like(y, dtype=np.promote_types(y.dtype, 'float32'))
+    if y.shape[-1] == 0:
+        return ewma
+
+    lam = np.asarray(lam, dtype=ewma.dtype)  # keep float32 series in float32
+
+    ewma[..., 0] = y[..., 0]
+    for i in range(1, y.shape[-1]):
+        ewma[..., i] = ewma[..., i - 1] * (1 - lam) + lam * y[..., i]
+
+    return ewma
+
+
+def _ucl_factor(
+        lam: float | np.ndarray,  # ewma lambda
+        position: np.ndarray  # 1-based position in kept dates
+) -> np.ndarray:
+    """
+    Part of the EWMA upper control limit that depends only on lambda and
+    position, i.e., the limit for a historical SD and multiplier of 1.
+    :param lam: Float or Numpy Array. EWMA lambda.
+    :param position: Numpy Array. 1-based position of each EWMA value.
+    :return: Numpy Array. Control limit factor per position.
+    """
+
+    return np.sqrt(lam / (2 - lam) * (1 - (1 - lam) ** (2 * position)))
+
+
+def _ewma_to_change(
+        ewma: np.ndarray,  # ewma values
+        histsd: np.ndarray,  # historical sd per pixel, broadcastable to ewma
+        position: np.ndarray,  # 1-based position of each ewma value in kept dates
+        lam: float,
+        lam_sigs: float,
+        rounding: bool
+) -> np.ndarray:
+    """
+    Converts EWMA values into change outputs using the EWMA upper control
+    limit at each kept position.
+    :param ewma: Numpy Array. EWMA values.
+    :param histsd: Numpy Array. Historical SD per pixel.
+    :param position: Numpy Array. 1-based position of each EWMA value.
+    :param lam: Float. EWMA lambda.
+    :param lam_sigs: Float. EWMA control limit multiplier.
+    :param rounding: Bool. Output change relative to control limit if True,
+    otherwise the rounded EWMA.
+    :return: Numpy Array. Change outputs, same shape as ewma.
+    """
+
+    # EWMA upper control limit. This is the threshold which dictates when the chart signals a disturbance
+    ucl = histsd * lam_sigs * _ucl_factor(lam, position).astype(np.asarray(histsd).dtype, copy=False)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if rounding is True:
+            tmp_2 = np.sign(ewma) * np.floor(np.abs(ewma / ucl))  # Rounded towards 0, +/-1 is the weakest signal
+        else:
+            tmp_2 = np.round(ewma, 0)  # EWMA outputs in terms of residual scales
+
+    return tmp_2
+
+
+def _persistence_runs(
+        tmp_2: np.ndarray,  # 2d ewma outputs of (pixels, dates)
+        persistence: int,  # min num of consecutive dates to keep a signal
+        num_keep: np.ndarray  # num of valid dates per row
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Run-length encodes the disturbance direction of each row and tracks,
+    per date, the sustained runs seen so far. Shared by the persistence
+    filter and the incremental update state.
+    :param tmp_2: Numpy Array. EWMA outputs of (pixels, dates).
+    :param persistence: Int. Min number of consecutive dates in one direction.
+    :param num_keep: Numpy Array. Number of valid leading dates per row.
+    :return: Tuple of Numpy Arrays, all (pixels, dates). Length of the run
+    each date is in, num of sustained dates so far, longest sustained run
+    so far and position (in order of sustained dates) of its first date.
+    """
+
+    num_rows, dates = tmp_2.shape
+
+    # disturbance direction, NaN after each row's valid dates so runs stop there
+    ind = np.arange(dates)
+    tmp_sign = np.where(ind < num_keep[:, None], np.sign(tmp_2), np.nan)
+
+    # run-length encode direction, a new run starts at each row start and direction change
+    is_start = np.ones_like(tmp_sign, dtype=bool)
+    is_start[:, 1:] = tmp_sign[:, 1:] != tmp_sign[:, :-1]
+    run_ids = np.cumsum(is_start.ravel()) - 1
+    tmp_3 = np.bincount(run_ids).astype('int32')[run_ids].reshape(num_rows, dates)
+    tmp_3[np.isnan(tmp_sign)] = -1  # NaN never matches itself
+
+    # positions (in order of sustained dates only) of first longest sustained run so far
+    is_sustained = tmp_3 >= persistence
+    num_sustained = np.cumsum(is_sustained, axis=1, dtype='int32')
+    run_max = np.maximum.accumulate(np.where(is_sustained, tmp_3, -1), axis=1)
+    run_max_prev = np.concatenate([np.full((num_rows, 1), -1, dtype='int32'), run_max[:, :-1]], axis=1)
+    is_new_max = is_sustained & (tmp_3 > run_max_prev)
+    m_ = np.maximum.accumulate(np.where(is_new_max, num_sustained - 1, -1), axis=1)
+
+    return tmp_3, num_sustained, run_max, m_
+
+
+def _apply_persistence(
+        tmp_2: np.ndarray,  # ewma outputs, dates along last axis
+        persistence: int,  # min num of consecutive dates to keep a signal
+        num_keep: np.ndarray = None,  # num of valid dates per row
+        clip_fallback: bool = False  # as per r, max(v, 0) of the previous sustained state
+) -> np.ndarray:
+    """
+    Keeps only EWMA values for which a disturbance is sustained, using
+    persistence as the threshold. Dates inside a shorter run are set to
+    the previous sustained state. Run lengths come from a run-length
+    encoding of the disturbance direction (see _persistence_runs), so each
+    row is O(n) and whole batches of (left-justified) series are handled
+    at once.
+    :param tmp_2: Numpy Array. EWMA outputs of (dates) or (pixels, dates).
+    :param persistence: Int. Min number of consecutive dates in one direction.
+    :param num_keep: Numpy Array. Number of valid leading dates per row. Dates
+    after this are ignored. Defaults to all dates.
+    :param clip_fallback: Bool. Clip the previous sustained state at 0, as
+    R does (the port keeps negative states). Defaults to False.
+    :return: Numpy Array. Persistence-filtered EWMA outputs, same shape as tmp_2.
+    """
+
+    tmp_2 = np.asarray(tmp_2)
+    if not np.issubdtype(tmp_2.dtype, np.floating):
+        tmp_2 = tmp_2.astype(float)  # float32 stays float32, NaN marks invalid dates
+    is_1d = tmp_2.ndim == 1
+    tmp_2 = np.atleast_2d(tmp_2)
+
+    if num_keep is None:
+        num_keep = np.full(tmp_2.shape[0], tmp_2.shape[1])
+
+    tmp_3, num_sustained, _, m_ = _persistence_runs(tmp_2, persistence, num_keep)
+    is_sustained = tmp_3 >= persistence
+
+    # TODO: m_ indexes tmp_2 directly (not the sustained dates), kept as per original port
+    v_ = np.take_along_axis(tmp_2, np.maximum(m_, 0), axis=1)
+    if clip_fallback:
+        v_ = np.maximum(v_, 0)
+
+    # if sustained dates are long enough, keep; otherwise set to previous sustained state
+    tmp_4 = np.where(is_sustained, tmp_2, np.where(num_sustained > 0, v_, 0))
+    tmp_4 = np.trunc(tmp_4)
+
+    return tmp_4[0] if is_1d else tmp_4
+
+
+def fill_gaps(
+        arr: np.ndarray,  # array of ewma outputs with gap codes
+        axis: int = -1,  # dates axis
+        gap: int = -2222  # coded 'no data' value
+) -> np.ndarray:
+    """
+    Fills every gap (missing or filtered date) with the last known value
+    along the dates axis (last observation carried forward). Works on a
+    single series or a full (time, y, x) cube by carrying the index of
+    the last non-gap date forward with a maximum-accumulate, rather than
+    stepping through dates. Leading gaps are left as is.
+    :param arr: Numpy Array. Values containing gap codes.
+    :param axis: Int. Axis of dates. Defaults to last.
+    :param gap: Int. Coded gap value. Defaults to -2222.
+    :return: Numpy Array. Gap-filled copy of arr.
+    """
+
+    arr = np.moveaxis(np.asarray(arr), axis, -1)
+
+    # index of each date if present, else 0, then carry latest index forward
+    idx = np.where(arr != gap, np.arange(arr.shape[-1], dtype='int32'), 0)
+    idx = np.maximum.accumulate(idx, axis=-1)
+
+    out = np.take_along_axis(arr, idx, axis=-1)
+
+    return np.moveaxis(out, -1, axis)
+
+
+def _ewmacd_kernel_py(
+        y: np.ndarray,  # kept residuals, left-justified
+        order: np.ndarray,  # date index of each kept position
+        ucl_f: np.ndarray,  # control limit factor per position
+        histsd: float,
+        num_keep: int,
+        is_run: bool,
+        lam: float,
+        lam_sigs: float,
+        rounding: bool,
+        persistence: int,
+        out: np.ndarray  # change codes for all dates
+) -> None:
+    """
+    Scalar per-pixel version of the downstream ewmacd_per_cube stage (EWMA,
+    control limits, persistence, unpack and gap filling) for one pixel, in
+    a single pass over its dates. Compiled into a generalised ufunc of
+    (time) -> (time) by numba when available (see _ewmacd_kernel), so it
+    is mapped over every pixel (and any parameter grid) without temporaries.
+    Follows the numpy engine operation for operation, so outputs are
+    bit-identical. Works in the dtype of y (float64 or float32) throughout.
+    Fills out with change codes as floats.
+    """
+
+    dates = y.shape[0]
+    n = num_keep
+    one = y.dtype.type(1)  # typed constant, keeps float32 arithmetic in float32
+
+    out[:] = -2222.0  # Coded 'No data' output
+    if not is_run:
+        return
+
+    # ewma over kept residuals relative to control limit
+    tmp_2 = np.empty(n, dtype=y.dtype)
+    ewma = y.dtype.type(0)
+    for i in range(n):
+        if i == 0:
+            ewma = y[0]
+        else:
+            ewma = ewma * (one - lam) + lam * y[i]
+
+        if rounding:
+            ucl = histsd * lam_sigs * ucl_f[i]
+            tmp_2[i] = np.sign(ewma) * np.floor(np.abs(ewma / ucl))
+        else:
+            tmp_2[i] = np.rint(ewma)
+
+    # keeping only values for which a disturbance is sustained
+    if persistence > 1 and n > 3:
+        # run length of disturbance direction per date, NaN never matches itself
+        run = np.empty(n, dtype=np.int64)
+        start = 0
+        for i in range(1, n + 1):
+            if i == n or not np.sign(tmp_2[i]) == np.sign(tmp_2[i - 1]):
+                for j in range(start, i):
+                    run[j] = -1 if np.isnan(tmp_2[j]) else i - start
+                start = i
+
+        # TODO: m_ indexes tmp_2 directly (not the sustained dates), kept as per original port
+        tmp_4 = np.empty(n, dtype=y.dtype)
+        num_sustained, run_max, m_ = 0, -1, -1
+        for i in range(n):
+            if run[i] >= persistence:
+                num_sustained += 1
+                if run[i] > run_max:
+                    run_max = run[i]
+                    m_ = num_sustained - 1
+                tmp_4[i] = tmp_2[i]
+            elif num_sustained > 0:
+                tmp_4[i] = tmp_2[m_]
+            else:
+                tmp_4[i] = 0.0
+
+        for i in range(n):
+            tmp_2[i] = np.trunc(tmp_4[i])
+
+    # unpack to the original dates, first date missing/filtered is no
+    # disturbance, then carry last ewma forward
+    k = 0
+    last = -2222.0
+    for t in range(dates):
+        val = -2222.0
+        if k < n and order[k] == t:
+            val = tmp_2[k]
+            k += 1
+
+        if t == 0 and val == -2222.0:
+            val = 0.0
+        if val == -2222.0:
+            val = last
+
+        out[t] = val
+        last = val
+
+
+if numba is not None:
+    _ewmacd_kernel = numba.guvectorize(
+        # float32 first, as numpy picks the first loop inputs safely cast to
+        ['void(float32[:], int32[:], float32[:], float32, int64, boolean, float32, float32, boolean, int64, float32[:])',
+         'void(float64[:], int32[:], float64[:], float64, int64, boolean, float64, float64, boolean, int64, float64[:])'],
+        '(n),(n),(n),(),(),(),(),(),(),()->(n)',
+        nopython=True,
+        cache=True
+    )(_ewmacd_kernel_py)
+else:
+    _ewmacd_kernel = None
+
+
 def ewmacd_per_pixel(
         pix,
         ns,
@@ -59,7 +660,8 @@ def ewmacd_per_pixel(
         lam,
         lam_sigs,
         rounding,
-        persistence
+        persistence,
+        r_compat=False  # reproduce known r differences, see parity
 ) -> None:
 
     # FIXME: lots of below can be simplified with xr
@@ -81,46 +683,48 @@ def ewmacd_per_pixel(
     history_bound_01 = len(bkgd_ind_01)  # Adjustment of training cutoff to reflect present data only
 
     pix_1 = pix_00[bkgd_ind_01]  # Present training data
-    timedat_01 = doys[bkgd_ind_01]  # Present training dates, note the implicit dependence on DOYS
-    timedat_1 = timedat_01 * 2 * np.pi / 365  # Conversion of training dates only to [0,2pi]
-    timedat_all = doys[bkgd_ind_00] * 2 * np.pi / 365  # Conversion of all present dates to [0,2pi]
+    X_dates = _get_harm_matrix(doys, ns, nc)  # Cached design matrix for all dates, note the implicit dependence on DOYS
+
+    X_all = X_dates[bkgd_ind_00]  # TODO: r script uses dates_00 and timedat_all, but redundant? check.
 
     # Checking if there is data to work with...
     if (len(pix_1) > 0):
         # build harm reg component matrix for train and all periods
-        X = _build_harm_matrix(timedat_1, ns, nc)
-        X_all = _build_harm_matrix(timedat_all, ns, nc)  # TODO: r script uses dates_00 and timedat_all, but redundant? check.
-
-        # if design matrix is of sufficient rank and non-singular...
-        if len(pix_1) > (ns + nc + 1) and np.abs(np.linalg.det(np.dot(X.T, X))) >= 0.001:
-            # solve least-squares estimation equation and fit based on brooks et al., 2014 eq. 4
-            # see how to do above via statsmodel here https://github.com/ChadFulton/sm-notebooks-2021/blob/main/002-seasonal-adjustment.ipynb
-            fit = np.linalg.solve(np.dot(X.T, X), np.dot(X.T, pix_1))
-            preds_1 = np.dot(X, fit)
-
-            # Block for X-bar chart anomaly filtering
-            # lt: this is done to remvoe extreme residual outliers (clouds) in training residuals
-            resids_1 = pix_1 - preds_1
-            std = np.std(resids_1, ddof=1)  # note: ddof 1 to match r
-            screen_1 = np.abs(resids_1) > (xbar_limit_1 * std)
-            keeps = np.where(~screen_1)[0]
-
-            # recompute a new estimate of the harmonic coefficients excluding outliers
-            if len(keeps) > ns + nc + 1:
-                X_k, pix_k = X[keeps], pix_1[keeps]
-                beta = np.linalg.solve(np.dot(X_k.T, X_k), np.dot(X_k.T, pix_k))
-
-            # testing
-            #plt.plot(pix_1, color='blue')
-            #plt.plot(preds_1, color='red')
-            #plt.show()
-
-            #plt.plot(resids_1, color='purple')
-            #plt.show()
+        X = X_dates[bkgd_ind_01]
+
+        with _stage('fit'):
+            # if design matrix is of sufficient rank and non-singular...
+            if len(pix_1) > (ns + nc + 1) and np.abs(np.linalg.det(np.dot(X.T, X))) >= 0.001:
+                # solve least-squares estimation equation and fit based on brooks et al., 2014 eq. 4
+                # see how to do above via statsmodel here https://github.com/ChadFulton/sm-notebooks-2021/blob/main/002-seasonal-adjustment.ipynb
+                fit = np.linalg.solve(np.dot(X.T, X), np.dot(X.T, pix_1))
+                preds_1 = np.dot(X, fit)
+
+                # Block for X-bar chart anomaly filtering
+                # lt: this is done to remvoe extreme residual outliers (clouds) in training residuals
+                resids_1 = pix_1 - preds_1
+                std = np.std(resids_1, ddof=1)  # note: ddof 1 to match r
+                screen_1 = np.abs(resids_1) > (xbar_limit_1 * std)
+                keeps = np.where(~screen_1)[0]
+
+                # recompute a new estimate of the harmonic coefficients excluding outliers
+                if len(keeps) > ns + nc + 1:
+                    X_k, pix_k = X[keeps], pix_1[keeps]
+                    if r_compat:
+                        pix_k = pix[keeps]  # r indexes the full series (myPixel[keeps]), not the training subset
+                    beta = np.linalg.solve(np.dot(X_k.T, X_k), np.dot(X_k.T, pix_k))
+
+                # testing
+                #plt.plot(pix_1, color='blue')
+                #plt.plot(preds_1, color='red')
+                #plt.show()
+
+                #plt.plot(resids_1, color='purple')
+                #plt.show()
 
         # ewma component
         if not np.isnan(beta[0]):  # Checking for present Beta
-            y_0 = pix_0 - np.dot(X_all, beta).T  # Residuals for all present data, based on training coefficients
+            y_0 = pix_0 - _predict_harm(beta, X_all)  # Residuals for all present data, based on training coefficients
             y_01 = y_0[0:history_bound_01]  # Training residuals only
 
             # testing
@@ -145,9 +749,7 @@ def ewmacd_per_pixel(
                 ind_02 = ind_0[history_bound_01:len(y_0)]
 
             # Creating date information in linear form (days from a starting point instead of Julian days of the year)
-            ea_year = np.insert(np.repeat(365, len(np.arange(training_start, testing_end))) + 1 * (np.arange(training_start, testing_end) % 4 == 0), 0, 0)
-            cu_year = np.cumsum(ea_year)
-            x_0 = (cu_year[years - training_start] + doys)[bkgd_ind_00]
+            x_0 = _linear_days(_get_date_index(years, doys), training_start)[bkgd_ind_00]  # Cached per series of dates
 
             # Modifying SD estimates based on anomalous readings in the training data
             ucl_0 = np.concatenate([np.repeat(xbar_limit_1, len(ind_01)), np.repeat(xbar_limit_2, len(ind_02))]) * histsd  # Note that we don't want to filter out the changes in the testing data, so xBarLimit2 is much larger!
@@ -156,24 +758,25 @@ def ewmacd_per_pixel(
             ind = ind_0[(pix_0 > low_thresh) & (np.abs(y_0) < ucl_0)]  # Keeping only dates for which we have some vegetation and aren't anomalously far from 0 in the residuals
             histsd = np.std(y_01[(pix_1 > low_thresh) & (np.abs(y_01) < ucl_0[0:history_bound_01])], ddof=1)  ### Updating the training SD estimate.  This is the all-important driver of the EWMA control limits.
 
-            if np.isnan(histsd):
-                #return tmp
-                raise
+            # as per r, no data output rather than raising, so one pixel never stops a batch,
+            # also where a zero sd would divide by zero (see STATUS_ZERO_SD)
+            if np.isnan(histsd) or histsd == 0 or np.ptp(pix_1) == 0:
+                dates = _get_date_index(years, doys)['dates'][bkgd_ind_00].astype('datetime64[us]').tolist()
+                return dates, pix_0, _predict_harm(beta, X_all), tmp
 
             totals = np.zeros_like(y_0)  # Future EWMA output
             tmp_2 = np.repeat(-2222, len(y))  # Coded values for the 'present' subset of the data
 
-            ewma = y[[0]]  # Initialize the EWMA outputs with the first present residual
-            for i in np.arange(1, len(y)):
-                ewma = np.append(ewma, ewma[i - 1] * (1 - lam) + lam * y[i])   # Appending new EWMA values for all present data.
+            with _stage('ewma'):
+                ewma = _ewma(y, lam)  # EWMA values for all present data, initialised with the first present residual
 
-            # TODO: check this - added the arange 1 to + 1
-            ucl = histsd * lam_sigs * np.sqrt(lam / (2 - lam) * (1 - (1 - lam) ** (2 * np.arange(1, len(y) + 1))))  # EWMA upper control limit.  This is the threshold which dictates when the chart signals a disturbance.
+                # TODO: check this - added the arange 1 to + 1
+                ucl = histsd * lam_sigs * np.sqrt(lam / (2 - lam) * (1 - (1 - lam) ** (2 * np.arange(1, len(y) + 1))))  # EWMA upper control limit.  This is the threshold which dictates when the chart signals a disturbance.
 
-            if rounding is True:
-                tmp_2 = np.sign(ewma) * np.floor(np.abs(ewma / ucl))  # Integer value for EWMA output relative to control limit (rounded towards 0).  A value of +/-1 represents the weakest disturbance signal
-            elif rounding is False:
-                tmp_2 = np.round(ewma, 0)  # EWMA outputs in terms of resdiual scales.
+                if rounding is True:
+                    tmp_2 = np.sign(ewma) * np.floor(np.abs(ewma / ucl))  # Integer value for EWMA output relative to control limit (rounded towards 0).  A value of +/-1 represents the weakest disturbance signal
+                elif rounding is False:
+                    tmp_2 = np.round(ewma, 0)  # EWMA outputs in terms of resdiual scales.
 
             # testing
             # plt.plot(pix_0, color='black')
@@ -186,42 +789,8 @@ def ewmacd_per_pixel(
 
             #  Keeping only values for which a disturbance is sustained, using persistence as the threshold
             if persistence > 1 and len(tmp_2) > 3:  # Ensuring sufficent data for tmp_2
-                tmp_sign = np.sign(tmp_2)  # Disturbance direction
-                shift_points = np.concatenate([[0], np.where(tmp_sign[1:] != tmp_sign[:len(tmp_sign) - 1])[0], [len(tmp_sign) - 1]])  # Dates for which direction changes
-
-                tmp_3 = np.repeat(0, len(tmp_sign))
-                for i in np.arange(0, len(tmp_sign)):  # Counting the consecutive dates in which directions are sustained
-                    tmp_3_lo = 0
-                    tmp_3_hi = 0
-
-                    while(i - tmp_3_lo >= 0):  # TODO: added >=
-                        if tmp_sign[i] - tmp_sign[(i - tmp_3_lo)] == 0:
-                            tmp_3_lo += 1
-                        else:
-                            break
-
-                    while(tmp_3_hi + i < len(tmp_sign)):  # TODO: was <=
-                        if tmp_sign[(i + tmp_3_hi)] - tmp_sign[i] == 0:
-                            tmp_3_hi += 1
-                        else:
-                            break
-
-                    tmp_3[i] = tmp_3_lo + tmp_3_hi - 1
-
-                tmp_4 = np.repeat(0, len(tmp_3))
-                for i in np.arange(len(tmp_3)):  # If sustained dates are long enough, keep; otherwise set to previous sustained state
-                    if tmp_3[i] >= persistence:
-                        tmp_4[i] = tmp_2[i]
-                    else:
-                        w_ = np.where(tmp_3[0:i + 1] >= persistence)[0]
-                        if len(w_) == 0:
-                            tmp_4[i] = 0
-                        else:
-                            m_ = np.argmax(tmp_3[w_])  # TODO: this whole rejigg is a mess, find a way to do this via pd
-                            v_=np.max(tmp_2[m_], 0)
-                            tmp_4[i] = v_
-
-                tmp_2 = tmp_4
+                with _stage('persistence'):
+                    tmp_2 = _apply_persistence(tmp_2, persistence, clip_fallback=r_compat)
 
             tmp[bkgd_ind_00[ind]] = tmp_2  # Assigning EWMA outputs for present data to the original template.  This still leaves -2222's everywhere the data was missing or filtered.
 
@@ -229,9 +798,8 @@ def ewmacd_per_pixel(
                 tmp[0] = 0
 
             if tmp[0] != -2222:  # If we have EWMA information for the first date, then for each missing/filtered date in the record, fill with the last known EWMA value
-                for stepper in np.arange(1, dates):
-                    if tmp[stepper] == -2222:
-                        tmp[stepper] = tmp[stepper - 1]
+                with _stage('fill_gaps'):
+                    tmp = fill_gaps(tmp)
 
             # testing
             #plt.plot(pix_0, color='black')
@@ -245,15 +813,1303 @@ def ewmacd_per_pixel(
     #return tmp # Final output.  All -2222's if data were insufficient to run the algorithm, otherwise an EWMA record of relative (rounded=T) or raw-residual (rounded=F) format.
 
     # lt added this
-    _years = years[bkgd_ind_00]
-    _doys = doys[bkgd_ind_00]
+    dates = _get_date_index(years, doys)['dates'][bkgd_ind_00].astype('datetime64[us]').tolist()  # as datetimes
+
+    return dates, pix_0, _predict_harm(beta, X_all), tmp  # pix_0
+
+
+def _masked_std(
+        vals: np.ndarray,  # 2d array of (pixels, dates)
+        mask: np.ndarray  # 2d bool array of (pixels, dates)
+) -> np.ndarray:
+    """
+    Sample standard deviation (ddof = 1, to match r) along dates axis
+    using only the values flagged in mask. Rows with less than 2 values
+    return NaN, like np.std on a single pixel would.
+    :param vals: Numpy Array. Values of shape (pixels, dates).
+    :param mask: Numpy Array. Bool mask of shape (pixels, dates).
+    :return: Numpy Array. Standard deviation per pixel.
+    """
+
+    num = mask.sum(axis=1).astype(vals.dtype)  # counts in value dtype so float32 stays float32
+    vals = np.where(mask, vals, 0.0)
 
-    dates = []
-    for y, d in zip(_years, _doys):
-        dt = datetime.datetime(int(y), 1, 1) + datetime.timedelta(int(d) - 1)
-        dates.append(dt)
+    # deviations overwrite the one masked copy, so only a single (pixels, dates) temporary
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = vals.sum(axis=1) / num
+        vals -= mean[:, None]
+        vals[~mask] = 0.0
+        std = np.sqrt(np.square(vals, out=vals).sum(axis=1) / (num - 1))
 
-    return dates, pix_0, np.dot(X_all, beta).T, tmp  # pix_0
+    std[num < 2] = np.nan
+
+    return std
+
+
+def _group_by_mask(
+        mask: np.ndarray  # 2d bool array of (pixels, dates)
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Groups pixels that share the exact same pattern of used dates. Rows are
+    packed into bytes so the unique search compares short keys rather than
+    full bool rows.
+    :param mask: Numpy Array. Bool mask of shape (pixels, dates).
+    :return: Tuple of Numpy Arrays. Unique masks of (groups, dates) and the
+    group index of each pixel.
+    """
+
+    keys = np.packbits(mask, axis=1)
+    keys = np.ascontiguousarray(keys).view(np.dtype((np.void, keys.shape[1])))[:, 0]
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+    return mask[first], inverse.ravel()
+
+
+def _solve_grouped_lstsq(
+        X: np.ndarray,  # design matrix of (dates, coefs)
+        pix: np.ndarray,  # 2d array of (pixels, dates)
+        mask: np.ndarray  # 2d bool array of (pixels, dates)
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Solves the least-squares harmonic fit for every pixel using only the
+    dates flagged in mask. Pixels sharing the same mask share the same
+    X.T X, so it is formed and factorised once per unique mask and then
+    applied to all right-hand sides X.T y of that group.
+    :param X: Numpy Array. Harmonic design matrix for all dates.
+    :param pix: Numpy Array. Pixel values of shape (pixels, dates).
+    :param mask: Numpy Array. Bool mask of dates to use per pixel.
+    :return: Tuple of Numpy Arrays. Coefficients of (pixels, coefs), NaN
+    where X.T X is singular, and determinant of X.T X per pixel.
+    """
+
+    num_dates, num_coefs = X.shape
+    masks, inverse = _group_by_mask(mask)
+
+    # form X.T X once per unique mask from outer products of design rows
+    X_outer = (X[:, :, None] * X[:, None, :]).reshape(num_dates, -1)
+    XtX = (masks.astype(X.dtype) @ X_outer).reshape(-1, num_coefs, num_coefs)
+    det = np.linalg.det(XtX)
+
+    # factorise each invertible X.T X once
+    XtX_inv = np.full_like(XtX, np.nan)
+    is_ok = det != 0
+    XtX_inv[is_ok] = np.linalg.solve(XtX[is_ok], np.eye(num_coefs))
+
+    # X.T y for all pixels in one product, then apply group inverse
+    Xty = np.where(mask, pix, 0.0) @ X
+    fit = np.einsum('pij,pj->pi', XtX_inv[inverse], Xty)
+
+    return fit, det[inverse]
+
+
+def _prepare_pix(
+        pix: np.ndarray,  # pixel values of any numeric dtype
+        scale: float = 1,
+        nodata: float = None,
+        dtype: str = 'float64'
+) -> np.ndarray:
+    """
+    Casts pixel values to the compute dtype, sets nodata to NaN and applies
+    scaling, e.g., native int16 values with a nodata code, or float32 NDVI
+    scaled by 10000 to suit the residual rounding and low threshold. Runs
+    per tile or chunk, so whole cubes can stay in their native dtype.
+    :param pix: Numpy Array. Pixel values.
+    :param scale: Float. Multiplier applied to values. Defaults to 1.
+    :param nodata: Float. Value treated as missing. Defaults to None.
+    :param dtype: String. Compute dtype, float64 or float32.
+    :return: Numpy Array. Pixel values in dtype, NaN where missing. Input is
+    returned as is if nothing needs changing.
+    """
+
+    dtype = np.dtype(dtype)
+    if pix.dtype == dtype and scale == 1 and nodata is None:
+        return pix
+
+    out = pix.astype(dtype)
+    if nodata is not None:
+        out[pix == nodata] = np.nan
+    if scale != 1:
+        out *= dtype.type(scale)
+
+    return out
+
+
+def _fit_ewmacd(
+        pix: np.ndarray,  # 2d array of (pixels, dates)
+        ns: int,
+        nc: int,
+        history_bound: int,
+        doys: np.ndarray,
+        xbar_limit_1: float,
+        xbar_limit_2: float,
+        low_thresh: float
+) -> dict:
+    """
+    Training stage of ewmacd_per_cube. Fits the harmonic regression, screens
+    X-bar outliers and computes residuals, kept dates and historical SDs for
+    every pixel. Nothing here depends on lambda, lambda sigmas, rounding or
+    persistence, so the result can be reused across those parameters.
+    :return: Dict of (read-only) Numpy Arrays. Coefficients ('beta'), fit for
+    all dates ('harm'), first and updated historical SD ('histsd_0',
+    'histsd'), pixels that can be run ('is_run'), num of kept dates
+    ('num_keep'), date index of each kept position ('order'), status code
+    per pixel ('status', see STATUS_*) and kept residuals left-justified per
+    pixel ('y').
+    """
+
+    num_pix, dates = pix.shape
+    num_coefs = ns + nc + 1
+
+    beta = np.full((num_pix, num_coefs), np.nan, dtype=pix.dtype)  # Coded 'No data' coefficients
+
+    ind_00 = np.arange(dates)  # Index list for original data
+    is_present = ~np.isnan(pix)  # Mask for all non-missing data
+    is_train = is_present & (ind_00 <= history_bound)  # Mask for non-missing training data
+    num_train = is_train.sum(axis=1)
+
+    # one design matrix for all dates, each pixel uses its own rows via masks
+    X_all = _get_harm_matrix(doys, ns, nc).astype(pix.dtype, copy=False)
+
+    # if design matrix is of sufficient rank and non-singular...
+    fit, det = _solve_grouped_lstsq(X_all, pix, is_train)
+    is_fit = (num_train > num_coefs) & (np.abs(det) >= 0.001)
+    is_sparse = num_train <= num_coefs  # too few dates to fit, or to refit below
+
+    if np.any(is_fit):
+        resids_1 = pix[is_fit] - fit[is_fit] @ X_all.T
+
+        # x-bar chart anomaly filtering on training residuals
+        std = _masked_std(resids_1, is_train[is_fit])
+        keeps = is_train[is_fit] & ~(np.abs(resids_1) > (xbar_limit_1 * std[:, None]))
+
+        # recompute coefficients excluding outliers where enough dates remain
+        is_refit = keeps.sum(axis=1) > num_coefs
+        is_sparse[np.where(is_fit)[0][~is_refit]] = True
+        fit_idx = np.where(is_fit)[0][is_refit]
+        beta[fit_idx], _ = _solve_grouped_lstsq(X_all, pix[fit_idx], keeps[is_refit])
+        del resids_1, keeps
+
+    harm = _predict_harm(beta, X_all)  # Harmonic fit for all dates, NaN where no beta
+
+    # ewma component
+    is_beta = ~np.isnan(beta[:, 0])
+    y_0 = pix - harm  # Residuals for all present data, based on training coefficients
+
+    histsd_0 = _masked_std(y_0, is_train)  # First estimate of historical SD
+    xbar_limits = np.where(ind_00 <= history_bound, xbar_limit_1, xbar_limit_2).astype(pix.dtype)
+    ucl_0 = xbar_limits * histsd_0[:, None]
+
+    # keep only dates with some vegetation and not anomalously far from 0 in the residuals
+    with np.errstate(invalid='ignore'):
+        keep = is_present & (pix > low_thresh) & (np.abs(y_0) < ucl_0)
+    del ucl_0
+
+    histsd = _masked_std(y_0, keep & is_train)  # Updated training SD, drives the EWMA control limits
+
+    # left-justify kept residuals per pixel so position i is the i-th kept date, as a stable
+    # argsort of ~keep would, from running counts in int32 (argsort gives int64 indexes). a
+    # kept date goes to its count of kept dates so far - 1, a dropped date t after all kept
+    # dates to num_keep + t - count
+    num_keep = keep.sum(axis=1)
+    is_drop = ~keep
+    pos = np.cumsum(keep, axis=1, dtype='int32')
+    pos -= keep
+    np.negative(pos, out=pos, where=is_drop)
+    np.add(pos, num_keep[:, None].astype('int32'), out=pos, where=is_drop)
+    np.add(pos, ind_00.astype('int32'), out=pos, where=is_drop)
+    order = np.empty_like(pos)
+    np.put_along_axis(order, pos, np.arange(dates, dtype='int32')[None], axis=1)
+    del pos, is_drop
+
+    # constant training values leave no variability to chart, (near) zero sd
+    is_flat = (np.max(pix, axis=1, where=is_train, initial=-np.inf) ==
+               np.min(pix, axis=1, where=is_train, initial=np.inf))
+    is_flat &= num_train > num_coefs
+
+    # why a pixel is not run, more specific causes are applied last
+    status = np.full(num_pix, STATUS_OK, dtype='uint8')
+    status[np.isnan(histsd)] = STATUS_NAN_SD
+    status[~is_beta] = np.where(is_sparse[~is_beta], STATUS_INSUFFICIENT, STATUS_SINGULAR)
+    status[is_flat | (histsd == 0)] = STATUS_ZERO_SD
+    status[is_present.any(axis=1) & ~(pix > low_thresh).any(axis=1)] = STATUS_LOW
+
+    fit = {
+        'beta': beta,
+        'harm': harm,
+        'histsd_0': histsd_0,
+        'histsd': histsd,
+        'is_run': status == STATUS_OK,
+        'num_keep': num_keep,
+        'order': order,
+        'status': status,
+        'y': np.take_along_axis(y_0, order, axis=1)
+    }
+
+    for arr in fit.values():
+        arr.setflags(write=False)
+
+    return fit
+
+
+def _get_fit(
+        pix: np.ndarray,
+        ns: int,
+        nc: int,
+        history_bound: int,
+        doys: np.ndarray,
+        xbar_limit_1: float,
+        xbar_limit_2: float,
+        low_thresh: float
+) -> dict:
+    """
+    Returns the training stage of ewmacd_per_cube (see _fit_ewmacd) from a
+    least-recently-used cache keyed on the pixel values, DOYs, training
+    window, harmonics, X-bar limits and low threshold, fitting on a miss.
+    Reruns that only change downstream parameters skip the fit entirely.
+    :return: Dict of (read-only) Numpy Arrays. See _fit_ewmacd.
+    """
+
+    key = (_hash_array(pix), _hash_array(doys), history_bound, ns, nc,
+           xbar_limit_1, xbar_limit_2, low_thresh)
+
+    fit = _cache_get(_fit_cache, key)
+    if fit is None:
+        fit = _fit_ewmacd(pix, ns, nc, history_bound, doys, xbar_limit_1, xbar_limit_2, low_thresh)
+        _cache_put(_fit_cache, key, fit, FIT_CACHE_SIZE, FIT_CACHE_BYTES)
+
+    return fit
+
+
+def _unpack_change(
+        tmp_2: np.ndarray,  # packed change outputs of (..., pixels, dates)
+        fit: dict,  # training stage
+        persistence: int,
+        rounding  # bool, or sequence of bools for a sweep
+) -> np.ndarray:
+    """
+    Applies persistence to packed change outputs, unpacks them back to the
+    original dates and fills missing/filtered dates. Any leading axes (e.g.,
+    a parameter grid) are handled in the same pass.
+    :param tmp_2: Numpy Array. Packed change outputs of (..., pixels, dates).
+    :param fit: Dict. Training stage, see _fit_ewmacd.
+    :param persistence: Int. Min number of consecutive dates to keep a signal.
+    :param rounding: Bool or List of Bools. Rounding option(s), sets the
+    output dtype (see _change_dtype).
+    :return: Numpy Array. Change codes of (..., pixels, dates) in int16 or
+    int32, -2222 where a pixel could not be processed.
+    """
+
+    shape = tmp_2.shape
+    num_pix, dates = shape[-2:]
+    tmp_2 = tmp_2.reshape(-1, num_pix, dates)
+
+    is_run, num_keep, order = fit['is_run'], fit['num_keep'], fit['order']
+
+    # keeping only values for which a disturbance is sustained
+    if persistence > 1:
+        with _stage('persistence'):
+            is_long = is_run & (num_keep > 3)  # Ensuring sufficent data for tmp_2
+            keep_long = np.tile(num_keep[is_long], len(tmp_2))
+            tmp_2 = tmp_2.copy()
+            tmp_2[:, is_long] = _apply_persistence(tmp_2[:, is_long].reshape(-1, dates),
+                                                   persistence,
+                                                   keep_long).reshape(len(tmp_2), -1, dates)
+
+    # unpack to the original dates, leaving -2222 where missing or filtered
+    with _stage('unpack'):
+        tmp = np.full(tmp_2.shape, -2222, dtype=_change_dtype(rounding))  # Coded 'No data' output
+        is_packed = (np.arange(dates) < num_keep[:, None]) & is_run[:, None]
+        rows = np.nonzero(is_packed)[0]
+        tmp[:, rows, order[is_packed]] = _encode_change(tmp_2[:, is_packed], rounding, inplace=True)
+
+        # first date missing/filtered is no disturbance
+        tmp[:, is_run, 0] = np.where(tmp[:, is_run, 0] == -2222, 0, tmp[:, is_run, 0])
+
+    # carry last ewma forward
+    with _stage('fill_gaps'):
+        tmp = fill_gaps(tmp, axis=-1)
+
+    return tmp.reshape(shape)
+
+
+def ewmacd_per_cube(
+        pix: np.ndarray,  # 2d array of (pixels, dates)
+        ns: int,
+        nc: int,
+        history_bound: int,
+        doys: np.ndarray,
+        xbar_limit_1: float,
+        xbar_limit_2: float,
+        low_thresh: float,
+        lam: float,
+        lam_sigs: float,
+        rounding: bool,
+        persistence: int,
+        return_state: bool = False,
+        use_cache: bool = False,
+        scale: float = 1,
+        nodata: float = None,
+        dtype: str = 'float64',
+        return_status: bool = False
+) -> tuple:
+    """
+    Vectorised version of ewmacd_per_pixel. Runs the harmonic fit, X-bar
+    screening, EWMA and control limits for every pixel at once. Each pixel
+    keeps its own set of present and screened dates via masks, and the
+    per-pixel subsets used by the EWMA are left-justified (packed) into a
+    shared array so every step is a whole-array operation. When numba is
+    installed, everything after the training fit runs in the compiled
+    per-pixel kernel instead (see _ewmacd_kernel_py), with identical output.
+    :param pix: Numpy Array. Pixel values of shape (pixels, dates), NaN = missing.
+    :param ns: Int. Number of sin harmonics.
+    :param nc: Int. Number of cos harmonics.
+    :param history_bound: Int. Index of last date in training period.
+    :param doys: Numpy Array. Day of year of each date.
+    :param xbar_limit_1: Float. X-bar limit for training residuals.
+    :param xbar_limit_2: Float. X-bar limit for testing residuals.
+    :param low_thresh: Float. Values at or below this are ignored.
+    :param lam: Float. EWMA lambda.
+    :param lam_sigs: Float. EWMA control limit multiplier.
+    :param rounding: Bool. Output change relative to control limit if True.
+    :param persistence: Int. Min number of consecutive dates to keep a signal.
+    :param return_state: Bool. Also return the per-pixel state needed by
+    ewmacd_update to append new dates. Defaults to False.
+    :param use_cache: Bool. Reuse a cached training fit for the same pixels
+    and training parameters. Defaults to False.
+    :param scale: Float. Multiplier applied to pixel values. Defaults to 1.
+    :param nodata: Float. Pixel value treated as missing. Defaults to None.
+    :param dtype: String. Compute dtype of pixel values and all (pixels,
+    dates) intermediates, float64 (bit-identical to ewmacd_per_pixel) or
+    float32 (half the memory). Defaults to float64.
+    :param return_status: Bool. Also return the status code of each pixel
+    (see STATUS_*). Defaults to False.
+    :return: Tuple of Numpy Arrays. Change codes (int16 rounded, int32
+    unrounded) and harmonic fit (in dtype), both of shape (pixels, dates).
+    Change codes are -2222 where a pixel could not be processed. Followed by the status codes of (pixels) if
+    return_status is True, and the state dict if return_state is True.
+    """
+
+    pix = _prepare_pix(pix, scale, nodata, dtype)
+
+    get_fit = _get_fit if use_cache else _fit_ewmacd
+    with _stage('fit'):
+        fit = get_fit(pix, ns, nc, history_bound, doys, xbar_limit_1, xbar_limit_2, low_thresh)
+
+    dates = pix.shape[1]
+    status = (fit['status'].copy(),) if return_status else ()
+
+    # compiled per-pixel kernel when available, state needs the packed arrays below
+    if _ewmacd_kernel is not None and not return_state:
+        with _stage('kernel'):
+            ucl_f = _ucl_factor(lam, np.arange(1, dates + 1)).astype(pix.dtype)
+            tmp = _ewmacd_kernel(fit['y'], fit['order'], ucl_f, fit['histsd'], fit['num_keep'], fit['is_run'],
+                                 pix.dtype.type(lam), pix.dtype.type(lam_sigs), bool(rounding), persistence)
+            tmp = _encode_change(tmp, rounding, inplace=True)
+        return (tmp, fit['harm'].copy()) + status
+
+    # ewma over kept residuals (padding after num_keep is ignored) relative to control limit
+    with _stage('ewma'):
+        ewma = _ewma(fit['y'], lam)
+        tmp_2 = _ewma_to_change(ewma, fit['histsd'][:, None], np.arange(1, dates + 1), lam, lam_sigs, rounding)
+
+    tmp = _unpack_change(tmp_2, fit, persistence, rounding)
+
+    out = (tmp, fit['harm'].copy()) + status
+
+    if return_state:
+        with _stage('state'):
+            state = _init_state(fit['beta'], fit['histsd_0'], fit['histsd'], fit['is_run'], fit['num_keep'],
+                                ewma, tmp_2, fit['order'], ns, nc, xbar_limit_2, low_thresh, lam, lam_sigs,
+                                rounding, persistence)
+        state['chng'] = tmp.copy()
+        state['num_dates'] = dates
+        return out + (state,)
+
+    return out
+
+
+def ewmacd_sweep_per_cube(
+        pix: np.ndarray,  # 2d array of (pixels, dates)
+        ns: int,
+        nc: int,
+        history_bound: int,
+        doys: np.ndarray,
+        xbar_limit_1: float,
+        xbar_limit_2: float,
+        low_thresh: float,
+        lams: list,
+        lam_sigs: list,
+        roundings: list,
+        persistences: list,
+        scale: float = 1,
+        nodata: float = None,
+        dtype: str = 'float64',
+        use_cache: bool = True
+) -> np.ndarray:
+    """
+    Evaluates ewmacd_per_cube over a grid of downstream parameters (lambda,
+    lambda sigmas, rounding and persistence) in one pass. The training fit
+    is computed once (and cached if use_cache), the EWMA is run once for all
+    lambdas together and control limits for all lambda sigmas are broadcast.
+    :param pix: Numpy Array. Pixel values of shape (pixels, dates), NaN = missing.
+    :param lams: List of Floats. EWMA lambdas.
+    :param lam_sigs: List of Floats. EWMA control limit multipliers.
+    :param roundings: List of Bools. Rounding options.
+    :param persistences: List of Ints. Persistence values.
+    :param use_cache: Bool. Reuse and keep the training fit in the fit
+    cache (see FIT_CACHE_BYTES). Defaults to True.
+    :return: Numpy Array. Change codes of (lams, lam_sigs, roundings,
+    persistences, pixels, dates). Other parameters as per ewmacd_per_cube.
+    """
+
+    pix = _prepare_pix(pix, scale, nodata, dtype)
+
+    get_fit = _get_fit if use_cache else _fit_ewmacd
+    fit = get_fit(pix, ns, nc, history_bound, doys, xbar_limit_1, xbar_limit_2, low_thresh)
+
+    num_pix, dates = pix.shape
+    lams = np.asarray(lams, dtype=pix.dtype)
+    sigs = np.asarray(lam_sigs, dtype=pix.dtype)
+
+    # compiled kernel broadcasts the whole grid over pixels in one call
+    if _ewmacd_kernel is not None:
+        out = _ewmacd_kernel(fit['y'], fit['order'],
+                             _ucl_factor(lams[:, None], np.arange(1, dates + 1)).astype(pix.dtype)[:, None, None, None, None],
+                             fit['histsd'], fit['num_keep'], fit['is_run'],
+                             lams[:, None, None, None, None],
+                             sigs[:, None, None, None],
+                             np.asarray(roundings, dtype=bool)[:, None, None],
+                             np.asarray(persistences, dtype=np.int64)[:, None])
+        return _encode_change(out, roundings, inplace=True)
+
+    # ewma for every lambda in one recursion, shape (lams, pixels, dates)
+    ewma = _ewma(np.broadcast_to(fit['y'], (len(lams), num_pix, dates)), lams[:, None])
+
+    out = np.empty((len(lams), len(sigs), len(roundings), len(persistences), num_pix, dates),
+                   dtype=_change_dtype(roundings))
+    for r, rounding in enumerate(roundings):
+        # (lams, lam_sigs, pixels, dates)
+        tmp_2 = _ewma_to_change(ewma[:, None],
+                                fit['histsd'][:, None],
+                                np.arange(1, dates + 1),
+                                lams[:, None, None, None],
+                                sigs[:, None, None],
+                                bool(rounding))
+
+        for p, persistence in enumerate(persistences):
+            out[:, :, r, p] = _unpack_change(tmp_2, fit, persistence, roundings)
+
+    return out
+
+
+def _init_state(
+        beta: np.ndarray,
+        histsd_0: np.ndarray,
+        histsd: np.ndarray,
+        is_run: np.ndarray,
+        num_keep: np.ndarray,
+        ewma: np.ndarray,
+        tmp_2: np.ndarray,
+        order: np.ndarray,
+        ns: int,
+        nc: int,
+        xbar_limit_2: float,
+        low_thresh: float,
+        lam: float,
+        lam_sigs: float,
+        rounding: bool,
+        persistence: int
+) -> dict:
+    """
+    Builds the per-pixel incremental state from the packed (left-justified)
+    intermediate arrays of ewmacd_per_cube, before persistence is applied.
+    :return: Dict. State used by ewmacd_update. See ewmacd_update.
+    """
+
+    num_pix = len(num_keep)
+    rows = np.arange(num_pix)
+    last = np.maximum(num_keep - 1, 0)
+    has_keep = num_keep > 0
+
+    # direction runs at the last kept date of each pixel
+    tmp_3, num_sustained, run_max, m_ = _persistence_runs(tmp_2, max(persistence, 1), num_keep)
+    run_len = np.where(has_keep, np.maximum(tmp_3[rows, last], 0), 0)
+    m_last = np.maximum(m_[rows, last], 0)
+
+    state = {
+        'ns': ns,
+        'nc': nc,
+        'xbar_limit_2': xbar_limit_2,
+        'low_thresh': low_thresh,
+        'lam': lam,
+        'lam_sigs': lam_sigs,
+        'rounding': rounding,
+        'persistence': persistence,
+        'beta': beta.copy(),
+        'histsd_0': histsd_0.copy(),
+        'histsd': histsd.copy(),
+        'is_run': is_run.copy(),
+        'num_keep': num_keep.copy(),
+        'ewma': np.where(has_keep, ewma[rows, last], np.nan),
+        'run_sign': np.where(has_keep, np.sign(tmp_2[rows, last]), np.nan),
+        'run_len': run_len,
+        'run_start': num_keep - run_len,
+        'max_run': np.where(has_keep, run_max[rows, last], -1),
+        'num_sustained': np.where(has_keep, num_sustained[rows, last], 0),
+        'fallback': np.where(has_keep, tmp_2[rows, m_last], 0.0),
+        'tmp_2': tmp_2.copy(),
+        'keep_idx': order.copy()
+    }
+
+    return state
+
+
+def _reserve(
+        state: dict,
+        key: str,
+        size: int
+) -> None:
+    """
+    Grows a (pixels, n) history array of the state so it holds at least
+    size columns. Capacity doubles, so appending is amortised O(1).
+    :param state: Dict. Incremental state.
+    :param key: String. Key of history array to grow.
+    :param size: Int. Min num of columns required.
+    :return: None.
+    """
+
+    arr = state[key]
+    if arr.shape[1] >= size:
+        return
+
+    new = np.zeros((arr.shape[0], max(size, 2 * arr.shape[1])), dtype=arr.dtype)
+    new[:, :arr.shape[1]] = arr
+    state[key] = new
+
+
+def _fill_new(
+        vals: np.ndarray,  # new change outputs
+        prev: np.ndarray  # change outputs of previous date
+) -> np.ndarray:
+    """
+    Truncates new change outputs to integers and, as fill_gaps would in a
+    full run, treats any output equal to the -2222 gap code as a gap.
+    :param vals: Numpy Array. New change outputs.
+    :param prev: Numpy Array. Change outputs of previous date.
+    :return: Numpy Array. Integer change outputs.
+    """
+
+    vals = np.trunc(vals)
+
+    return np.where(vals == -2222, prev, vals)
+
+
+def ewmacd_update(
+        state: dict,
+        pix: np.ndarray,  # 1d array of new values per pixel
+        doy: int  # day of year of new date
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Appends one new (testing period) date to a state returned by
+    ewmacd_per_cube(..., return_state=True) without refitting the history.
+    Training coefficients, historical SDs, last EWMA value and current
+    direction run length and sign are kept per pixel, so each update is
+    O(1) per pixel. Persistence is not causal: when the current run becomes
+    sustained, its earlier dates are rewritten in state['chng'], exactly as a
+    full rerun would produce them. The state is updated in place.
+    :param state: Dict. Incremental state.
+    :param pix: Numpy Array. New value per pixel, NaN = missing.
+    :param doy: Int. Day of year of new date.
+    :return: Tuple of Numpy Arrays. Change codes and harmonic fit of the new
+    date per pixel.
+    """
+
+    lam, persistence = state['lam'], state['persistence']
+    t = state['num_dates']
+
+    _reserve(state, 'chng', t + 1)
+    _reserve(state, 'tmp_2', int(state['num_keep'].max()) + 1)
+    _reserve(state, 'keep_idx', int(state['num_keep'].max()) + 1)
+    chng = state['chng']
+
+    # residual of new date against training coefficients
+    X = _get_harm_matrix(np.array([doy]), state['ns'], state['nc'])[0]
+    harm = _predict_harm(state['beta'], X)
+    y = pix - harm
+
+    # keep only dates with some vegetation and not anomalously far from 0 in the residuals
+    with np.errstate(invalid='ignore'):
+        keep = state['is_run'] & (pix > state['low_thresh']) & (np.abs(y) < state['xbar_limit_2'] * state['histsd_0'])
+
+    # missing/filtered dates carry last ewma forward
+    chng[:, t] = np.where(state['is_run'], chng[:, t - 1], -2222)
+    state['num_dates'] = t + 1
+
+    rows = np.where(keep)[0]
+    if len(rows) == 0:
+        return chng[:, t].copy(), harm
+
+    # next ewma value and change relative to the control limit
+    k = state['num_keep'][rows]
+    ewma = np.where(k == 0, y[rows], state['ewma'][rows] * (1 - lam) + lam * y[rows])
+    tmp_2 = _ewma_to_change(ewma, state['histsd'][rows], k + 1, lam, state['lam_sigs'], state['rounding'])
+
+    state['ewma'][rows] = ewma
+    state['tmp_2'][rows, k] = tmp_2
+    state['keep_idx'][rows, k] = t
+    state['num_keep'][rows] = k + 1
+
+    if persistence <= 1:
+        chng[rows, t] = _fill_new(tmp_2, chng[rows, t - 1])
+        return chng[:, t].copy(), harm
+
+    # extend current direction run or start a new one
+    sign = np.sign(tmp_2)
+    is_same = sign == state['run_sign'][rows]
+    run_len = np.where(is_same, state['run_len'][rows] + 1, 1)
+    run_start = np.where(is_same, state['run_start'][rows], k)
+
+    # a run reaching persistence makes all of its dates sustained at once
+    is_sustained = run_len >= persistence
+    is_newly = run_len == persistence
+    num_sustained = state['num_sustained'][rows] + np.where(is_newly, persistence, is_sustained.astype(int))
+
+    # track first longest sustained run and the value it falls back to (as per original port)
+    is_new_max = is_sustained & (run_len > state['max_run'][rows])
+    m_ = np.where(is_new_max, num_sustained - run_len, 0)
+    fallback = np.where(is_new_max, state['tmp_2'][rows, m_], state['fallback'][rows])
+
+    state['run_sign'][rows] = sign
+    state['run_len'][rows] = run_len
+    state['run_start'][rows] = run_start
+    state['num_sustained'][rows] = num_sustained
+    state['max_run'][rows] = np.where(is_new_max, run_len, state['max_run'][rows])
+    state['fallback'][rows] = fallback
+
+    # not enough kept dates for persistence yet, output raw values
+    is_long = k + 1 > 3
+    vals = np.where(~is_long, tmp_2, np.where(is_sustained, tmp_2, np.where(num_sustained > 0, fallback, 0)))
+    chng[rows, t] = _fill_new(vals, chng[rows, t - 1])
+
+    # rewrite earlier dates where persistence changed their output
+    for i in np.where(is_long & (is_newly | (k + 1 == 4)))[0]:
+        r = rows[i]
+        if k[i] + 1 == 4:
+            start = 0
+            vals = _apply_persistence(state['tmp_2'][r, :4], persistence)
+        else:
+            start = run_start[i]
+            vals = state['tmp_2'][r, start:k[i] + 1]
+
+        # seed with output before the rewritten span, as a full run would fill from it
+        dates_ = state['keep_idx'][r, start:k[i] + 1]
+        seg = np.full(t + 2 - dates_[0], -2222)
+        seg[0] = chng[r, dates_[0] - 1] if dates_[0] > 0 else 0
+        seg[dates_ - dates_[0] + 1] = np.trunc(vals)
+        chng[r, dates_[0]:t + 1] = fill_gaps(seg)[1:]
+
+    return chng[:, t].copy(), harm
+
+
+def save_state(
+        state: dict,
+        out_path: str
+) -> None:
+    """
+    Saves an incremental EWMACD state to a compressed numpy (.npz) file.
+    History arrays are trimmed to their used size.
+    :param state: Dict. Incremental state.
+    :param out_path: String. Output file path.
+    :return: None.
+    """
+
+    out = state.copy()
+    out['chng'] = state['chng'][:, :state['num_dates']]
+    out['tmp_2'] = state['tmp_2'][:, :max(int(state['num_keep'].max()), 1)]
+    out['keep_idx'] = state['keep_idx'][:, :max(int(state['num_keep'].max()), 1)]
+
+    np.savez_compressed(out_path, **out)
+
+
+def load_state(in_path: str) -> dict:
+    """
+    Loads an incremental EWMACD state saved by save_state.
+    :param in_path: String. Input file path.
+    :return: Dict. Incremental state.
+    """
+
+    with np.load(in_path) as data:
+        state = {key: data[key] for key in data.files}
+
+    # scalars come back as 0d arrays
+    for key in ['ns', 'nc', 'persistence', 'num_dates']:
+        state[key] = int(state[key])
+    for key in ['xbar_limit_2', 'low_thresh', 'lam', 'lam_sigs']:
+        state[key] = float(state[key])
+    state['rounding'] = bool(state['rounding'])
+
+    return state
+
+
+def _share_array(
+        shape: tuple,
+        dtype: str,
+        name: str = None
+) -> tuple[shared_memory.SharedMemory, np.ndarray]:
+    """
+    Creates (name is None) or attaches to (name given) a block of shared
+    memory and returns a numpy view onto it, so workers can read and write
+    tiles of a cube without pickling arrays between processes.
+    :param shape: Tuple. Array shape.
+    :param dtype: String. Numpy dtype.
+    :param name: String. Name of existing shared memory block. Defaults to
+    None, in which case a new block is created.
+    :return: Tuple. Shared memory block and array view onto it.
+    """
+
+    if name is None:
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    else:
+        shm = shared_memory.SharedMemory(name=name)
+
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    return shm, arr
+
+
+def _worker_ewmacd_tile(
+        start: int,
+        stop: int,
+        shms: dict,
+        shape: tuple,
+        params: dict
+) -> tuple[int, int]:
+    """
+    Process pool worker. Attaches to the shared input and output cubes,
+    runs ewmacd_per_cube on pixels start to stop and writes results back
+    into shared memory in place.
+    :param start: Int. First pixel of tile.
+    :param stop: Int. Last pixel of tile (exclusive).
+    :param shms: Dict. Shared memory dtypes and names for 'pix', 'chng',
+    'harm' and 'status'.
+    :param shape: Tuple. Shape of (pixels, dates) arrays.
+    :param params: Dict. Keyword arguments for ewmacd_per_cube.
+    :return: Tuple. Start and stop of finished tile.
+    """
+
+    shm_pix, pix = _share_array(shape, *shms['pix'])
+    shm_chng, chng = _share_array(shape, *shms['chng'])
+    shm_harm, harm = _share_array(shape, *shms['harm'])
+    shm_status, status = _share_array(shape[:1], *shms['status'])
+
+    try:
+        tmp, harm[start:stop], status[start:stop] = ewmacd_per_cube(pix[start:stop], return_status=True, **params)
+        chng[start:stop] = _encode_change(tmp, params['rounding'])
+    finally:
+        del pix, chng, harm, status
+        for shm in [shm_pix, shm_chng, shm_harm, shm_status]:
+            shm.close()
+
+    return start, stop
+
+
+def ewmacd_per_cube_parallel(
+        pix: np.ndarray,  # 2d array of (pixels, dates)
+        number_cpu: int,
+        tile_size: int = TILE_SIZE,
+        **params
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Runs ewmacd_per_cube over a process pool. Pixels are split into tiles
+    of contiguous pixels (row-major strips of the site) and every worker
+    reads its tile from, and writes results to, shared memory. Only tile
+    bounds and parameters are sent to workers. With only one tile or one
+    cpu, tiles are run one after another in-process into preallocated
+    outputs, so engine memory is bounded by tile_size on every path.
+    :param pix: Numpy Array. Pixel values of shape (pixels, dates), NaN = missing.
+    :param number_cpu: Int or 'all'. Number of worker processes.
+    :param tile_size: Int. Number of pixels per tile.
+    :param params: Keyword arguments for ewmacd_per_cube.
+    :return: Tuple of Numpy Arrays. Change codes (int16 rounded, int32
+    unrounded) and harmonic fit, both of shape (pixels, dates), and status
+    codes of (pixels).
+    """
+
+    if number_cpu == 'all':
+        number_cpu = os.cpu_count()
+
+    num_pix = pix.shape[0]
+    tiles = [(i, min(i + tile_size, num_pix)) for i in range(0, num_pix, tile_size)]
+
+    harm_dtype = params.get('dtype', 'float64')
+    chng_dtype = _change_dtype(params['rounding'])
+
+    number_cpu = min(int(number_cpu or 1), len(tiles))
+    if number_cpu <= 1:
+        chng = np.empty(pix.shape, dtype=chng_dtype)
+        harm = np.empty(pix.shape, dtype=harm_dtype)
+        status = np.empty(pix.shape[:1], dtype='uint8')
+        for start, stop in tiles:
+            chng[start:stop], harm[start:stop], status[start:stop] = ewmacd_per_cube(pix[start:stop],
+                                                                                     return_status=True,
+                                                                                     **params)
+        return chng, harm, status
+
+    # input stays in its native dtype, conversion happens per tile in workers
+    shm_pix, pix_shared = _share_array(pix.shape, pix.dtype)
+    shm_chng, chng = _share_array(pix.shape, chng_dtype)
+    shm_harm, harm = _share_array(pix.shape, harm_dtype)
+    shm_status, status = _share_array(pix.shape[:1], 'uint8')
+    shms = {
+        'pix': (pix.dtype.str, shm_pix.name),
+        'chng': (chng_dtype, shm_chng.name),
+        'harm': (harm_dtype, shm_harm.name),
+        'status': ('uint8', shm_status.name)
+    }
+
+    try:
+        pix_shared[:] = pix
+
+        with _stage('workers'), ProcessPoolExecutor(max_workers=number_cpu) as pool:
+            futures = []
+            for start, stop in tiles:
+                task = pool.submit(_worker_ewmacd_tile, start, stop, shms, pix.shape, params)
+                futures.append(task)
+
+            for future in as_completed(futures):
+                future.result()  # raise any worker error
+
+        chng, harm, status = chng.copy(), harm.copy(), status.copy()
+
+    finally:
+        del pix_shared
+        for shm in [shm_pix, shm_chng, shm_harm, shm_status]:
+            shm.close()
+            shm.unlink()
+
+    return chng, harm, status
+
+
+def _ewmacd_block(
+        pix: np.ndarray,  # nd array with dates along last axis
+        **params
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Runs ewmacd_per_cube on a single block of any shape with dates along the
+    last axis, as handed over by xr.apply_ufunc for each dask chunk.
+    :param pix: Numpy Array. Block of pixel values, dates along last axis.
+    :param params: Keyword arguments for ewmacd_per_cube.
+    :return: Tuple of Numpy Arrays. Harmonic fit (HARM_DTYPE) and change
+    codes (int16 rounded, int32 unrounded), both the same shape as pix, and
+    status codes of the shape of pix without dates.
+    """
+
+    shape = pix.shape
+    chng, harm, status = ewmacd_per_cube(pix.reshape(-1, shape[-1]), return_status=True, **params)
+
+    return (harm.reshape(shape).astype(HARM_DTYPE, copy=False),
+            _encode_change(chng, params['rounding']).reshape(shape),
+            status.reshape(shape[:-1]))
+
+
+def _change_dtype(
+        rounding  # bool, or sequence of bools for a sweep
+) -> str:
+    """
+    Compact output dtype of change codes, see CHNG_DTYPES.
+    :param rounding: Bool or List of Bools. Rounding option(s).
+    :return: String. Numpy dtype name.
+    """
+
+    return CHNG_DTYPES[bool(np.all(rounding))]
+
+
+def _encode_change(
+        chng: np.ndarray,
+        rounding,  # bool, or sequence of bools for a sweep
+        inplace: bool = False  # chng is a temporary that may be clipped in place
+) -> np.ndarray:
+    """
+    Casts change codes to their compact output dtype. Codes outside its
+    range are saturated rather than wrapped.
+    :param chng: Numpy Array. Change codes.
+    :param rounding: Bool or List of Bools. Rounding option(s).
+    :param inplace: Bool. Clip chng in place rather than in a copy, for
+    temporaries such as float engine outputs. Defaults to False.
+    :return: Numpy Array. Change codes in int16 or int32.
+    """
+
+    info = np.iinfo(_change_dtype(rounding))
+    if chng.dtype == info.dtype:
+        return chng
+
+    chng = np.clip(chng, info.min, info.max, out=chng if inplace else None)
+
+    return chng.astype(info.dtype, copy=False)
+
+
+def _encode_harm(
+        harm: np.ndarray,
+        scale: float = 1
+) -> np.ndarray:
+    """
+    Casts the harmonic fit to HARM_DTYPE in the units of the input ndvi.
+    :param harm: Numpy Array. Harmonic fit in engine (scaled) units.
+    :param scale: Float. Multiplier applied to ndvi values in the engine.
+    :return: Numpy Array. Harmonic fit in HARM_DTYPE.
+    """
+
+    harm = harm.astype(HARM_DTYPE, copy=False)
+    if scale != 1:
+        harm = harm / np.float32(scale)
+
+    return harm
+
+
+def _to_dataset(
+        da: xr.DataArray,  # ndvi of (time) or (time, y, x)
+        harm,
+        chng,
+        rounding: bool,
+        scale: float = 1,
+        status=None
+) -> xr.Dataset:
+    """
+    Packs ewmacd outputs into a dataset on the coords of the ndvi input, so
+    results for millions of pixels stay as compact arrays and write straight
+    to netcdf. The harmonic fit is returned in the units of the input ndvi
+    (scale removed) as HARM_DTYPE, and change codes as int16 (rounded) or
+    int32 (unrounded), with the status code of each pixel as a band.
+    :param da: Xarray DataArray. Ndvi input, time first.
+    :param harm: Numpy Array or DataArray. Harmonic fit, same shape as da.
+    :param chng: Numpy Array or DataArray. Change codes, same shape as da.
+    :param rounding: Bool. Rounding option the change codes were run with.
+    :param scale: Float. Multiplier applied to ndvi values in the engine.
+    :param status: Numpy Array or DataArray. Status codes (see STATUS_*),
+    shape of da without time. Defaults to None.
+    :return: Xarray Dataset. Variables ndvi, harm, chng and, if given, status.
+    """
+
+    ds = xr.Dataset(coords=da.coords)
+    ds['ndvi'] = da
+    ds['harm'] = (da.dims, _encode_harm(harm, scale))
+    ds['chng'] = (da.dims, _encode_change(chng, rounding))
+
+    ds['chng'].attrs['nodata'] = -2222
+
+    if status is not None:
+        ds['status'] = (da.dims[1:], status)
+        ds['status'].attrs['flag_values'] = np.arange(len(STATUS_MEANINGS.split()), dtype='uint8')
+        ds['status'].attrs['flag_meanings'] = STATUS_MEANINGS
+
+    return ds
+
+
+def _change_counts(
+        chng,  # numpy or dask array, dates along axis 0
+        axis: tuple
+):
+    """
+    Per-date pixel counts of a change map: pixels with a change code (not
+    -2222), flagged pixels (any non-zero code) and disturbed pixels
+    (negative code, i.e., a decline from the fit).
+    :param chng: Numpy or Dask Array. Change codes with dates along axis 0.
+    :param axis: Tuple of Ints. Spatial axes to count over.
+    :return: Numpy or Dask Array. Counts of (3, dates).
+    """
+
+    is_valid = chng != -2222
+
+    return np.stack([is_valid.sum(axis),
+                     (is_valid & (chng != 0)).sum(axis),
+                     (is_valid & (chng < 0)).sum(axis)])
+
+
+def _pixel_area(da: xr.DataArray) -> float:
+    """
+    Pixel area from the spacing of the x and y coords, assuming square
+    pixels where a dim is a single pixel wide.
+    :param da: Xarray DataArray. Cube with x and y coords.
+    :return: Float. Pixel area in squared coord units, 1 if unknown.
+    """
+
+    res = [float(np.abs(np.diff(da[dim].values[:2]))[0]) for dim in ['x', 'y'] if da.sizes[dim] > 1]
+
+    if not res:
+        return 1.0
+
+    return res[0] * res[-1]
+
+
+def _add_summaries(
+        ds: xr.Dataset,
+        counts,  # numpy or dask array of (3, dates), see _change_counts
+        ndvi_median=None  # numpy or dask array of (dates)
+) -> xr.Dataset:
+    """
+    Adds site level summaries per date to an ewmacd cube output: the median
+    ndvi series (ndvi_median), the percent of pixels flagged (flagged_pct)
+    and the area disturbed (disturbed_area, in squared coord units, e.g.,
+    m2 for epsg 3577). All come from arrays of the same run, so the cube is
+    not read again.
+    :param ds: Xarray Dataset. Ewmacd cube output.
+    :param counts: Numpy or Dask Array. Pixel counts, see _change_counts.
+    :param ndvi_median: Numpy or Dask Array. Median ndvi per date, if known.
+    :return: Xarray Dataset. Dataset with summary variables added.
+    """
+
+    num_valid, num_flagged, num_disturbed = counts
+
+    if ndvi_median is not None:
+        ds['ndvi_median'] = ('time', ndvi_median)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ds['flagged_pct'] = ('time', (100 * num_flagged / num_valid).astype('float32'))
+
+    ds['disturbed_area'] = ('time', (num_disturbed * _pixel_area(ds)).astype('float32'))
+
+    return ds
+
+
+def _run_id(
+        da: xr.DataArray,  # ndvi of (time, y, x)
+        tile_rows: int,
+        params: dict
+) -> str:
+    """
+    Identifies a streamed ewmacd run by its parameters, dates, cube shape
+    and tiling, so a partially written output is only ever resumed by the
+    same run.
+    :param da: Xarray DataArray. Ndvi input of (time, y, x).
+    :param tile_rows: Int. Rows per tile.
+    :param params: Dict. Keyword arguments for ewmacd_per_cube.
+    :return: String. Hex digest.
+    """
+
+    scalars = {k: v for k, v in params.items() if k != 'doys'}
+    key = json.dumps([scalars, da.shape, tile_rows], sort_keys=True, default=str)
+
+    h = hashlib.sha1(key.encode())
+    h.update(np.ascontiguousarray(params['doys']).tobytes())
+    h.update(np.ascontiguousarray(da['time'].values).tobytes())
+
+    return h.hexdigest()
+
+
+def _open_output_nc(
+        out_nc: str,
+        da: xr.DataArray,  # ndvi of (time, y, x)
+        tile_rows: int,
+        run_id: str,
+        rounding: bool,
+        overwrite: bool = False
+) -> netCDF4.Dataset:
+    """
+    Opens the output netcdf of a streamed ewmacd run for writing, creating
+    it if missing. Coords (with cf time encoding) are written by xarray, then
+    harm, chng and status are added as zlib compressed variables chunked by
+    tile, so each finished tile is written to its own chunks. A tile_done
+    flag per tile records progress for resuming, and tile_counts the tile's
+    change counts for site summaries.
+    :param out_nc: String. Output netcdf path.
+    :param da: Xarray DataArray. Ndvi input of (time, y, x).
+    :param tile_rows: Int. Rows per tile.
+    :param run_id: String. Run identifier, see _run_id.
+    :param rounding: Bool. Rounding option, sets dtype of chng.
+    :param overwrite: Bool. Replace an existing output of a different run
+    instead of raising.
+    :return: NetCDF4 Dataset. Open in append mode.
+    """
+
+    if os.path.exists(out_nc):
+        nc = netCDF4.Dataset(out_nc, 'a')
+        if getattr(nc, 'ewmacd_run', None) == run_id:
+            return nc
+
+        nc.close()
+        if not overwrite:
+            raise ValueError(f'Output {out_nc} exists from a different run, remove it or use another file name.')
+
+        os.remove(out_nc)
+
+    xr.Dataset(coords=da.coords).to_netcdf(out_nc)
+
+    num_dates, num_rows, num_cols = da.shape
+    chunks = (num_dates, tile_rows, num_cols)
+
+    nc = netCDF4.Dataset(out_nc, 'a')
+    try:
+        nc.createDimension('tile', -(-num_rows // tile_rows))
+
+        harm = nc.createVariable('harm', HARM_DTYPE, ('time', 'y', 'x'), zlib=True, chunksizes=chunks,
+                                 fill_value=np.nan)
+        chng = nc.createVariable('chng', _change_dtype(rounding), ('time', 'y', 'x'), zlib=True,
+                                 chunksizes=chunks, fill_value=False)
+        status = nc.createVariable('status', 'u1', ('y', 'x'), zlib=True, chunksizes=chunks[1:],
+                                   fill_value=False)
+        done = nc.createVariable('tile_done', 'u1', ('tile',), fill_value=False)
+
+        # per tile change counts (see _change_counts), written with the tile so resumes keep them
+        nc.createDimension('count', 3)
+        nc.createVariable('tile_counts', 'i4', ('tile', 'count', 'time'), fill_value=False)
+
+        chng.nodata = -2222
+        status.flag_values = np.arange(len(STATUS_MEANINGS.split()), dtype='u1')
+        status.flag_meanings = STATUS_MEANINGS
+        done[:] = 0
+
+        nc.ewmacd_run = run_id
+        nc.sync()
+
+    except Exception:
+        nc.close()
+        raise
+
+    return nc
+
+
+def _write_nc_summaries(
+        out_nc: str,
+        da: xr.DataArray  # ndvi of (time, y, x)
+) -> None:
+    """
+    Adds site summaries per date (flagged_pct and disturbed_area, see
+    _add_summaries) to a streamed ewmacd output, from the change counts
+    recorded per tile as it was written, so the output is not read again.
+    The median ndvi is not decomposable over tiles and is left out.
+    :param out_nc: String. Output netcdf path of ewmacd_to_nc.
+    :param da: Xarray DataArray. Ndvi input of (time, y, x).
+    :return: None.
+    """
+
+    with netCDF4.Dataset(out_nc, 'a') as nc:
+        counts = np.asarray(nc['tile_counts'][:]).sum(axis=0)
+        ds = _add_summaries(xr.Dataset(coords=da.coords), counts)
+
+        for name in ['flagged_pct', 'disturbed_area']:
+            if name not in nc.variables:
+                nc.createVariable(name, 'f4', ('time',))
+            nc[name][:] = ds[name].values
+
+
+def _worker_ewmacd_strip(
+        pix: np.ndarray,  # (time, rows, cols)
+        params: dict
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Process pool worker for streamed runs. Runs ewmacd_per_cube on one tile
+    (a strip of rows) and returns its compact outputs.
+    :param pix: Numpy Array. Tile of pixel values of (time, rows, cols).
+    :param params: Dict. Keyword arguments for ewmacd_per_cube.
+    :return: Tuple of Numpy Arrays. Harmonic fit and change codes, both of
+    (time, rows, cols), and status codes of (rows, cols).
+    """
+
+    harm, chng, status = _ewmacd_block(np.moveaxis(pix, 0, -1), **params)
+
+    return np.moveaxis(harm, -1, 0), np.moveaxis(chng, -1, 0), status
+
+
+def ewmacd_to_nc(
+        da: xr.DataArray,  # ndvi of (time, y, x), numpy, dask or lazily read
+        out_nc: str,
+        number_cpu: int = 1,
+        tile_size: int = TILE_SIZE,
+        overwrite: bool = False,
+        **params
+) -> None:
+    """
+    Runs ewmacd over a cube tile by tile (strips of rows of about tile_size
+    pixels) and streams each finished tile into a chunked, compressed
+    netcdf, so neither the input nor the output cube is ever held in memory
+    in full. Tiles are read from da as needed and, on multiple cpus, run
+    on a process pool with a bounded number of tiles in flight. Progress is
+    recorded per tile, so rerunning with the same inputs and parameters
+    after a crash only runs the unfinished tiles.
+    :param da: Xarray DataArray. Ndvi input of (time, y, x).
+    :param out_nc: String. Output netcdf path.
+    :param number_cpu: Int or 'all'. Number of worker processes.
+    :param tile_size: Int. Approximate number of pixels per tile.
+    :param overwrite: Bool. Replace an existing output of a different run
+    (e.g., new dates or parameters) instead of raising.
+    :param params: Keyword arguments for ewmacd_per_cube.
+    """
+
+    if number_cpu == 'all':
+        number_cpu = os.cpu_count()
+
+    num_dates, num_rows, num_cols = da.shape
+    tile_rows = int(np.clip(tile_size // max(num_cols, 1), 1, num_rows))
+
+    nc = _open_output_nc(out_nc, da, tile_rows, _run_id(da, tile_rows, params), params['rounding'], overwrite)
+
+    try:
+        todo = np.where(nc['tile_done'][:] == 0)[0]
+        tiles = [(i, i * tile_rows, min((i + 1) * tile_rows, num_rows)) for i in todo]
+
+        def write(tile, harm, chng, status):
+            i, start, stop = tile
+            with _stage('write'):
+                nc['harm'][:, start:stop, :] = _encode_harm(harm, params.get('scale', 1))
+                nc['chng'][:, start:stop, :] = chng
+                nc['status'][start:stop, :] = status
+                nc['tile_counts'][i] = _change_counts(chng, (1, 2))
+                nc['tile_done'][i] = 1
+                nc.sync()  # flushed per tile, so a crash loses at most the tiles in flight
+
+        def read(tile):
+            with _stage('subset'):
+                return np.asarray(da[:, tile[1]:tile[2], :].values)
+
+        number_cpu = min(int(number_cpu or 1), len(tiles))
+        if number_cpu <= 1:
+            for tile in tiles:
+                write(tile, *_worker_ewmacd_strip(read(tile), params))
+            return
+
+        # keep at most two tiles per worker read into memory at once
+        with _stage('workers'), ProcessPoolExecutor(max_workers=number_cpu) as pool:
+            pending = {}
+            for tile in tiles:
+                pending[pool.submit(_worker_ewmacd_strip, read(tile), params)] = tile
+
+                while len(pending) >= number_cpu * 2:
+                    future = next(as_completed(pending))
+                    write(pending.pop(future), *future.result())
+
+            for future in as_completed(list(pending)):
+                write(pending.pop(future), *future.result())
+
+    finally:
+        nc.close()
+
+
+def _subset_years(
+        ds: xr.Dataset,  # dataset with time dim
+        training_start: int,
+        training_end: int,
+        testing_end: int
+) -> tuple:
+    """
+    Subsets a dataset to the training and testing years and extracts the
+    date inputs needed by the ewmacd engine.
+    :return: Tuple. Subset dataset, Numpy Arrays of doys and years, and Int
+    index of the last date in the training period.
+    """
+
+    # extract arrays of doys and years in order of xr
+    years, doys = _years_doys(ds['time'].values)
+
+    # lt: subset dates via xr easier
+    is_kept = (years >= training_start) & (years < testing_end)
+    ds = ds.isel(time=is_kept)
+    years, doys = years[is_kept], doys[is_kept]
+
+    # get index of last year in training period
+    history_bound = np.max(np.where(years < training_end))
+
+    return ds, doys, years, history_bound
 
 
 def ewmacd(
@@ -271,59 +2127,226 @@ def ewmacd(
         persistence=3,
         number_cpu=4,
         write_file=False,
-        file_name=None
+        file_name=None,
+        scale=1,  # e.g., 10000 for ndvi, instead of scaling the whole dataset up front
+        nodata=None,  # value treated as missing, e.g., -999 for native int16 values
+        dtype='float64',  # float32 halves memory of full cube runs
+        overwrite=False,  # replace file_name if written by a different run, otherwise it is resumed or raises
+        summarise=False  # add site summaries per date to cube output, see _add_summaries
 ):
     ns = nc = number_harmonics
 
-    # lt: subset dates via xr easier
-    ds = ds.sel(time=ds['time'].dt.year >= training_start)
-    ds = ds.sel(time=ds['time'].dt.year < testing_end)
-
-    # extract arrays of doys and years in order of xr
-    doys = ds['time'].dt.dayofyear.values
-    years = ds['time'].dt.year.values
-
-    # get index of last year in training period
-    history_bound = np.max(np.where(years < training_end))
-
-    # FIXME: working on only 1 pixel for now, adapt to whole netcdf
-    #pix = ds['ndvi'].isel(x=0, y=0).values
-    #pix = ds['ndvi'].median(['x', 'y']).values
-    pix = ds['ndvi'].values
-
-    # call per-pixel ewmacd func
-    dates, ndvi_y, harm_y, resi_y = ewmacd_per_pixel(pix,
-                                                     ns,
-                                                     nc,
-                                                     history_bound,
-                                                     doys,
-                                                     years,
-                                                     training_start,
-                                                     training_end,
-                                                     testing_end,
-                                                     xbar_limit_1,
-                                                     xbar_limit_2,
-                                                     low_thresh,
-                                                     lam,
-                                                     lam_sigs,
-                                                     rounding,
-                                                     persistence)
-
+    with _stage('subset'):
+        ds, doys, years, history_bound = _subset_years(ds, training_start, training_end, testing_end)
+
+    # full cube mode: run every pixel at once and return a dataset
+    if 'x' in ds['ndvi'].dims and 'y' in ds['ndvi'].dims:
+        da = ds['ndvi'].transpose('time', 'y', 'x')
+
+        params = {
+            'ns': ns,
+            'nc': nc,
+            'history_bound': history_bound,
+            'doys': doys,
+            'xbar_limit_1': xbar_limit_1,
+            'xbar_limit_2': xbar_limit_2,
+            'low_thresh': low_thresh,
+            'lam': lam,
+            'lam_sigs': lam_sigs,
+            'rounding': rounding,
+            'persistence': persistence,
+            'scale': scale,
+            'nodata': nodata,
+            'dtype': dtype
+        }
+
+        # stream tiles to netcdf as they finish and return the path, not a dataset reading from
+        # it, so file_name is never left open (open it with xr.open_dataset when needed, e.g.,
+        # dropping the tile_done and tile_counts progress variables)
+        if write_file:
+            if not file_name:
+                raise ValueError('A file name is required when writing to file.')
+
+            ewmacd_to_nc(da, file_name, number_cpu, overwrite=overwrite, **params)
+
+            if summarise:
+                _write_nc_summaries(file_name, da)
+
+            return file_name
+
+        # dask-backed cube: stay lazy, run chunk-wise over (y, x) with time whole
+        if da.chunks is not None:
+            da = da.chunk({'time': -1})
+
+            harm, chng, status = xr.apply_ufunc(_ewmacd_block,
+                                                da,
+                                                input_core_dims=[['time']],
+                                                output_core_dims=[['time'], ['time'], []],
+                                                dask='parallelized',
+                                                output_dtypes=[HARM_DTYPE, _change_dtype(rounding), 'uint8'],
+                                                kwargs=params)
+
+            ds_out = _to_dataset(da, harm.transpose('time', 'y', 'x').data, chng.transpose('time', 'y', 'x').data,
+                                 rounding, scale, status.transpose('y', 'x').data)
+
+            # lazy too, so computing the output reads each input chunk once
+            if summarise:
+                ndvi = da if nodata is None else da.where(da != nodata)
+                ds_out = _add_summaries(ds_out,
+                                        _change_counts(ds_out['chng'].data, (1, 2)),
+                                        ndvi.median(['y', 'x']).data)
+
+            return ds_out
+
+        # flatten to (pixels, dates) for the vectorised engine
+        with _stage('subset'):
+            pix = da.values.reshape(len(doys), -1).T
+
+        # split into tiles across number_cpu processes
+        chng, harm, status = ewmacd_per_cube_parallel(pix, number_cpu, **params)
+
+        # reshape back to (time, y, x) and pack into a dataset
+        with _stage('output'):
+            ds_out = _to_dataset(da, harm.T.reshape(da.shape), chng.T.reshape(da.shape), rounding, scale,
+                                 status.reshape(da.shape[1:]))
+
+        # from the arrays already in memory, no second read of the cube
+        if summarise:
+            with _stage('summarise'), warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)  # all nan dates give nan
+                ndvi_median = np.nanmedian(_prepare_pix(pix, 1, nodata, dtype), axis=0)
+                ds_out = _add_summaries(ds_out, _change_counts(ds_out['chng'].values, (1, 2)), ndvi_median)
+
+        return ds_out
+
+    # single series mode (e.g., site median)
+    with _stage('subset'):
+        pix = _prepare_pix(ds['ndvi'].values, scale, nodata, dtype)
+
+    # run as a one pixel cube, reusing the cached training fit so that only
+    # lambda, lambda sigmas, rounding or persistence changes skip the refit
+    chng, harm, status = ewmacd_per_cube(pix[None],
+                                         ns,
+                                         nc,
+                                         history_bound,
+                                         doys,
+                                         xbar_limit_1,
+                                         xbar_limit_2,
+                                         low_thresh,
+                                         lam,
+                                         lam_sigs,
+                                         rounding,
+                                         persistence,
+                                         use_cache=True,
+                                         dtype=dtype,
+                                         return_status=True)
 
     # calc the per-pixel ewmacd func
     # tmpOutput = EWMACD.pixel.
     # for .calc.lt(myPixel, ns, nc, historybound, DOYs, xBarLimit1, trainingStart, testingEnd, Years, xBarLimit2,
     # lowthresh, lambda, lambdasigs, rounding, persistence, trainingEnd)
 
-    # convert from numpy arrays to lists
-    dates = list(dates)
-    ndvi_y = list(ndvi_y)
-    harm_y = list(harm_y)
-    resi_y = list(resi_y)
+    # ndvi, fit and change on the datetime64 time coord, missing ndvi = NaN
+    with _stage('output'):
+        ds_out = _to_dataset(ds['ndvi'], harm[0], chng[0], rounding, scale, status[0])
+
+    if write_file:
+        if not file_name:
+            raise ValueError('A file name is required when writing to file.')
+
+        with _stage('write'):
+            ds_out[['harm', 'chng', 'status']].to_netcdf(file_name, encoding={'harm': {'zlib': True},
+                                                                               'chng': {'zlib': True}})
+
+    return ds_out
+
+
+def ewmacd_sweep(
+        ds: xr.Dataset,  # dataset with ndvi var
+        training_start: int,
+        training_end: int,
+        testing_end: int,
+        number_harmonics: int = 2,
+        xbar_limit_1: float = 1.5,
+        xbar_limit_2: float = 20,
+        low_thresh: float = 100,
+        lams: tuple = (0.3,),
+        lam_sigs: tuple = (3,),
+        roundings: tuple = (True,),
+        persistences: tuple = (3,),
+        scale: float = 1,
+        nodata: float = None,
+        dtype: str = 'float64'
+) -> xr.DataArray:
+    """
+    Runs ewmacd over a grid of lambda, lambda sigmas, rounding and persistence
+    values in one batched pass. The harmonic fit, residuals and screened dates
+    depend only on the training window, harmonics, X-bar limits and low
+    threshold, so they are fitted once (and cached) and every combination of
+    the downstream parameters is evaluated from them. Useful for calibration
+    sliders and sensitivity sweeps.
+    :param ds: Xarray Dataset. Dataset with ndvi variable of (time) or (time, y, x).
+    :param training_start: Int. First year of training period.
+    :param training_end: Int. Year after the last year of training period.
+    :param testing_end: Int. Year after the last year of testing period.
+    :param number_harmonics: Int. Number of sin and cos harmonics.
+    :param xbar_limit_1: Float. X-bar limit for training residuals.
+    :param xbar_limit_2: Float. X-bar limit for testing residuals.
+    :param low_thresh: Float. Values at or below this are ignored.
+    :param lams: Tuple of Floats. EWMA lambdas.
+    :param lam_sigs: Tuple of Floats. EWMA control limit multipliers.
+    :param roundings: Tuple of Bools. Rounding options.
+    :param persistences: Tuple of Ints. Persistence values.
+    :param scale: Float. Multiplier applied to ndvi values. Defaults to 1.
+    :param nodata: Float. Ndvi value treated as missing. Defaults to None.
+    :param dtype: String. Compute dtype, float64 or float32.
+    :return: Xarray DataArray. Change codes (int16, or int32 if any run is
+    unrounded) of (lam, lam_sigs, rounding, persistence, time) or (...,
+    time, y, x) for a cube.
+    """
 
-    #return tmp
-    return dates, ndvi_y, harm_y, resi_y
+    ns = nc = number_harmonics
 
+    ds, doys, years, history_bound = _subset_years(ds, training_start, training_end, testing_end)
+
+    da = ds['ndvi']
+    if 'x' in da.dims and 'y' in da.dims:
+        da = da.transpose('time', 'y', 'x')
+
+    # flatten to (pixels, dates) for the vectorised engine
+    pix = da.values.reshape(len(doys), -1).T
+
+    chng = ewmacd_sweep_per_cube(pix,
+                                 ns,
+                                 nc,
+                                 history_bound,
+                                 doys,
+                                 xbar_limit_1,
+                                 xbar_limit_2,
+                                 low_thresh,
+                                 list(lams),
+                                 list(lam_sigs),
+                                 list(roundings),
+                                 list(persistences),
+                                 scale,
+                                 nodata,
+                                 dtype)
+
+    # move dates first and restore spatial dims
+    chng = np.moveaxis(chng, -1, -2).reshape(chng.shape[:4] + da.shape)
+
+    coords = {
+        'lam': list(lams),
+        'lam_sigs': list(lam_sigs),
+        'rounding': list(roundings),
+        'persistence': list(persistences)
+    }
+    coords.update(da.coords)
+
+    return xr.DataArray(_encode_change(chng, roundings),
+                        dims=('lam', 'lam_sigs', 'rounding', 'persistence') + da.dims,
+                        coords=coords,
+                        name='chng')
 
 
 def test():
@@ -338,7 +2361,6 @@ def test():
     ds = ds.resample(time='1MS').median()
 
     #ds = ds.fillna(0.2)
-    ds = ds * 10000   # FIXME: decimal values not working when rounding=False, need to * 10000
 
     dts = ds['time'].data
     dts = dts[dts >= np.datetime64('2020-01-31T00:00:00.000000000')]
@@ -347,7 +2369,7 @@ def test():
         print(dt)
         _ds = ds.where(ds['time'] <= dt, drop=True)
 
-        dates, ndvi_y, harm_y, resi_y = ewmacd(
+        ds_ewm = ewmacd(
             _ds,
             training_start=2017,
             training_end=2019,
@@ -363,18 +2385,22 @@ def test():
             persistence=1,  # 3,
             number_cpu=1,
             write_file=False,
-            file_name=None
+            file_name=None,
+            scale=10000  # ndvi scaled in the engine, decimal values not working when rounding=False
         )
 
+        # plot fit on present dates only, change for all dates
+        ds_vals = ds_ewm.where(ds_ewm['ndvi'].notnull(), drop=True)
+
         fig = plt.figure(figsize=[10, 6])
 
         plt.subplot(2, 1, 1)
-        plt.plot(dates, ndvi_y, color='black', marker='.')
-        plt.plot(dates, harm_y, color='green', marker='.')
+        plt.plot(ds_vals['time'], ds_vals['ndvi'], color='black', marker='.')
+        plt.plot(ds_vals['time'], ds_vals['harm'], color='green', marker='.')
         plt.grid()
 
         plt.subplot(2, 1, 2)
-        plt.plot(dates, resi_y, color='red', marker='.')
+        plt.plot(ds_ewm['time'], ds_ewm['chng'], color='red', marker='.')
         plt.grid()
 
         plt.tight_layout()
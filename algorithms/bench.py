@@ -0,0 +1,406 @@
+"""
+Benchmarks for the ewmacd engine on the bundled sample stack, the test
+cubes and synthetic cubes. Run from the repository root, e.g.:
+
+    python -m algorithms.bench
+    python -m algorithms.bench --sizes 1000 100000 --dates 50 150 --out bench.json
+    python -m algorithms.bench --compare bench.json
+
+Every case records wall time, throughput (pixels/s), peak memory and the
+per-stage breakdown from algos.profile_stages. Results can be saved as
+json and compared against a previous run to catch regressions.
+"""
+
+import os
+import json
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import xarray as xr
+
+from algorithms import algos
+
+try:
+    import tifffile
+except ImportError:  # optional, rasterio is used for the sample stack when missing
+    tifffile = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLE_STACK = os.path.join(ROOT, 'EWMACD v1.3.0', 'Sample Data - Angle Index x1000 Stack.tif')
+SAMPLE_DOYS = os.path.join(ROOT, 'EWMACD v1.3.0', 'Temporal Distribution with DOY.csv')
+TEST_CUBES = [os.path.join(ROOT, 'testing', 'cb.nc'), os.path.join(ROOT, 'testing', 'burn.nc')]
+
+# synthetic cube sizes (pixels) and series lengths (dates)
+SYNTH_SIZES = [1_000, 10_000, 100_000, 1_000_000, 10_000_000]
+SYNTH_DATES = [50, 150, 300]
+
+# ewmacd parameters shared by every case, as per ewmacd defaults
+PARAMS = {
+    'ns': 2,
+    'nc': 2,
+    'xbar_limit_1': 1.5,
+    'xbar_limit_2': 20,
+    'low_thresh': 100,
+    'lam': 0.3,
+    'lam_sigs': 3,
+    'rounding': True,
+    'persistence': 3
+}
+
+
+def _measure(
+        name: str,  # case name
+        num_pix: int,
+        num_dates: int,
+        func,  # callable running the case
+        repeats: int = 1
+) -> dict:
+    """
+    Runs func repeats times with caches cleared before each, and records the
+    best wall time, throughput and stage timings. Peak memory comes from a
+    separate run under tracemalloc, which would otherwise skew the timings.
+    :param name: String. Name of case.
+    :param num_pix: Int. Number of pixels processed per call.
+    :param num_dates: Int. Number of dates per pixel.
+    :param func: Callable. Runs the case, takes no arguments.
+    :param repeats: Int. Number of timed calls.
+    :return: Dict. Benchmark record.
+    """
+
+    best, stages = np.inf, {}
+    for _ in range(repeats):
+        algos.clear_caches()
+
+        with algos.profile_stages() as report:
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+
+        if elapsed < best:
+            best, stages = elapsed, report
+
+    algos.clear_caches()
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'name': name,
+        'pixels': int(num_pix),
+        'dates': int(num_dates),
+        'seconds': best,
+        'pixels_per_sec': num_pix / best if best > 0 else np.inf,
+        'peak_mb': peak / 1024 ** 2,
+        'stages': {k: round(v['seconds'], 6) for k, v in stages.items()}
+    }
+
+
+def read_stack(
+        in_path: str  # path to multi-band tif
+) -> np.ndarray:
+    """
+    Reads the sample stack as (y, x, dates) floats, NaN where negative.
+    :param in_path: String. Path to stack.
+    :return: Numpy Array. Pixel values.
+    """
+
+    if tifffile is not None:
+        arr = tifffile.imread(in_path)
+    else:
+        import rasterio
+        with rasterio.open(in_path) as src:
+            arr = np.moveaxis(src.read(), 0, -1)
+
+    arr = arr.astype('float64')
+    arr[arr < 0] = np.nan
+
+    return arr
+
+
+def read_doy_table(
+        in_path: str  # path to date info csv
+) -> np.ndarray:
+    """
+    Reads the sample stack date table (Year, Month, Day, DOY columns).
+    :param in_path: String. Path to csv.
+    :return: Numpy Array. Ints of (dates, 4).
+    """
+
+    return np.loadtxt(in_path, delimiter=',', skiprows=1, dtype=int, ndmin=2)
+
+
+def _read_cube_ndvi(
+        in_path: str  # path to test cube nc
+) -> xr.Dataset:
+    """
+    Opens a test cube and derives ndvi (* 10000) with -999 as nodata.
+    :param in_path: String. Path to netcdf.
+    :return: Xarray Dataset. Dataset with ndvi variable of (time, y, x).
+    """
+
+    ds = xr.open_dataset(in_path).load()
+    ds = ds.where(ds != -999)
+
+    ds['ndvi'] = ((ds['nbart_nir_1'] - ds['nbart_red']) /
+                  (ds['nbart_nir_1'] + ds['nbart_red']))
+
+    return ds[['ndvi']] * 10000
+
+
+def make_synthetic(
+        num_pix: int,
+        num_dates: int,
+        seed: int = 0
+) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Builds a synthetic cube of seasonal vegetation index series with noise,
+    missing dates, cloud dips and a disturbance in the testing period of
+    half the pixels. Dates are 16 days apart, first third is training.
+    :param num_pix: Int. Number of pixels.
+    :param num_dates: Int. Number of dates.
+    :param seed: Int. Random seed.
+    :return: Tuple. Pixel values of (pixels, dates), doys and index of last
+    training date.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    dts = np.datetime64('2000-01-01') + np.arange(num_dates) * 16
+    doys = (dts - dts.astype('datetime64[Y]')).astype(int) + 1
+    years = dts.astype('datetime64[Y]').astype(int) + 1970
+
+    # training period is the whole years in the first third of dates
+    train_end = years[num_dates // 3]
+    history_bound = int(np.max(np.where(years < max(train_end, years[0] + 1))))
+
+    phase = rng.uniform(0, 2 * np.pi, (num_pix, 1))
+    pix = 3000 + 1500 * np.sin(2 * np.pi * doys / 365 + phase)
+    pix += rng.normal(0, 300, (num_pix, num_dates))
+
+    pix[rng.random(pix.shape) < 0.05] = 500  # cloud dips
+    pix[rng.random(pix.shape) < 0.2] = np.nan  # missing dates
+
+    # step disturbance at a random testing date in half the pixels
+    is_dist = rng.random(num_pix) < 0.5
+    onset = rng.integers(history_bound + 1, num_dates, num_pix)
+    pix[is_dist[:, None] & (np.arange(num_dates) >= onset[:, None])] -= 2000
+
+    return pix, doys, history_bound
+
+
+def bench_single_pixel(
+        repeats: int = 5
+) -> list[dict]:
+    """
+    Benchmarks a single series (site median of each test cube) via the
+    per-pixel reference and via ewmacd.
+    :param repeats: Int. Number of timed calls per case.
+    :return: List of Dicts. Benchmark records.
+    """
+
+    records = []
+    for in_path in TEST_CUBES:
+        ds = _read_cube_ndvi(in_path).median(['x', 'y'])
+        name = os.path.splitext(os.path.basename(in_path))[0]
+
+        ds = ds.sel(time=(ds['time'].dt.year >= 2017) & (ds['time'].dt.year < 2025))
+        pix = ds['ndvi'].values
+        doys = ds['time'].dt.dayofyear.values
+        years = ds['time'].dt.year.values
+        history_bound = int(np.max(np.where(years < 2019)))
+
+        def run_reference():
+            algos.ewmacd_per_pixel(pix.copy(), PARAMS['ns'], PARAMS['nc'], history_bound, doys, years,
+                                   2017, 2019, 2025, PARAMS['xbar_limit_1'], PARAMS['xbar_limit_2'],
+                                   PARAMS['low_thresh'], PARAMS['lam'], PARAMS['lam_sigs'],
+                                   PARAMS['rounding'], PARAMS['persistence'])
+
+        def run_ewmacd():
+            algos.ewmacd(ds, 2017, 2019, 2025)
+
+        records.append(_measure(f'pixel_reference_{name}', 1, len(pix), run_reference, repeats))
+        records.append(_measure(f'pixel_ewmacd_{name}', 1, len(pix), run_ewmacd, repeats))
+
+    return records
+
+
+def bench_stack(
+        number_cpu: int = 1,
+        repeats: int = 3
+) -> list[dict]:
+    """
+    Benchmarks the full sample stack (2005-2014, training to 2009) and the
+    full test cubes (2017-2024, training to 2019) via ewmacd.
+    :param number_cpu: Int. Number of worker processes.
+    :param repeats: Int. Number of timed calls per case.
+    :return: List of Dicts. Benchmark records.
+    """
+
+    records = []
+
+    if os.path.exists(SAMPLE_STACK):
+        arr = read_stack(SAMPLE_STACK)
+        dts = read_doy_table(SAMPLE_DOYS)
+        times = [np.datetime64(f'{y:04d}-{m:02d}-{d:02d}') for y, m, d in dts[:, :3]]
+
+        ds = xr.Dataset({'ndvi': (('y', 'x', 'time'), arr)}, coords={'time': times})
+
+        def run_sample():
+            algos.ewmacd(ds, 2005, 2009, 2015, number_cpu=number_cpu)
+
+        num_pix = arr.shape[0] * arr.shape[1]
+        records.append(_measure('stack_sample', num_pix, arr.shape[2], run_sample, repeats))
+
+    for in_path in TEST_CUBES:
+        ds = _read_cube_ndvi(in_path)
+        name = os.path.splitext(os.path.basename(in_path))[0]
+
+        def run_cube():
+            algos.ewmacd(ds, 2017, 2019, 2025, number_cpu=number_cpu)
+
+        num_pix = ds.sizes['x'] * ds.sizes['y']
+        records.append(_measure(f'stack_{name}', num_pix, ds.sizes['time'], run_cube, repeats))
+
+    return records
+
+
+def bench_synthetic(
+        sizes: list = None,
+        dates: list = None,
+        tile_size: int = 100_000,
+        dtype: str = 'float64'
+) -> list[dict]:
+    """
+    Benchmarks ewmacd_per_cube on synthetic cubes of each size and series
+    length. Cubes larger than tile_size pixels are generated and run one
+    tile at a time so 10M pixel cubes fit in memory, thus peak memory is
+    per tile and only engine time (not generation) is counted.
+    :param sizes: List of Ints. Number of pixels per cube.
+    :param dates: List of Ints. Number of dates per series.
+    :param tile_size: Int. Max pixels generated and run at once.
+    :param dtype: String. Engine compute dtype, float64 or float32.
+    :return: List of Dicts. Benchmark records.
+    """
+
+    sizes = sizes or SYNTH_SIZES
+    dates = dates or SYNTH_DATES
+
+    records = []
+    for num_dates in dates:
+        for num_pix in sizes:
+            seconds, peak, stages = 0.0, 0.0, {}
+            for i, start in enumerate(range(0, num_pix, tile_size)):
+                pix, doys, history_bound = make_synthetic(min(tile_size, num_pix - start), num_dates, seed=i)
+
+                def run_tile():
+                    algos.ewmacd_per_cube(pix, history_bound=history_bound, doys=doys, dtype=dtype, **PARAMS)
+
+                rec = _measure('tile', len(pix), num_dates, run_tile)
+                seconds += rec['seconds']
+                peak = max(peak, rec['peak_mb'])
+                for k, v in rec['stages'].items():
+                    stages[k] = stages.get(k, 0.0) + v
+
+            records.append({
+                'name': f'synthetic_{num_pix}x{num_dates}' + ('' if dtype == 'float64' else f'_{dtype}'),
+                'pixels': num_pix,
+                'dates': num_dates,
+                'seconds': seconds,
+                'pixels_per_sec': num_pix / seconds if seconds > 0 else np.inf,
+                'peak_mb': peak,
+                'stages': {k: round(v, 6) for k, v in stages.items()}
+            })
+
+            print(_format_record(records[-1]), flush=True)
+
+    return records
+
+
+def compare(
+        records: list[dict],  # current run
+        baseline: list[dict],  # previous run
+        tolerance: float = 0.2
+) -> list[str]:
+    """
+    Compares throughput of a run against a baseline run by case name.
+    :param records: List of Dicts. Current benchmark records.
+    :param baseline: List of Dicts. Baseline benchmark records.
+    :param tolerance: Float. Allowed fractional drop in throughput.
+    :return: List of Strings. Names of cases that regressed beyond tolerance.
+    """
+
+    base = {r['name']: r for r in baseline}
+
+    regressed = []
+    for rec in records:
+        prev = base.get(rec['name'])
+        if prev is not None and rec['pixels_per_sec'] < prev['pixels_per_sec'] * (1 - tolerance):
+            regressed.append(rec['name'])
+
+    return regressed
+
+
+def _format_record(
+        rec: dict  # benchmark record
+) -> str:
+    """
+    Formats a benchmark record as a single table row.
+    :param rec: Dict. Benchmark record.
+    :return: String. Row.
+    """
+
+    return (f"{rec['name']:<32} {rec['pixels']:>10} px {rec['dates']:>4} dates "
+            f"{rec['seconds']:>10.4f} s {rec['pixels_per_sec']:>12.0f} px/s {rec['peak_mb']:>9.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ewmacd engine.')
+    parser.add_argument('--cases', nargs='+', default=['pixel', 'stack', 'synthetic'],
+                        choices=['pixel', 'stack', 'synthetic'])
+    parser.add_argument('--sizes', nargs='+', type=int, default=SYNTH_SIZES)
+    parser.add_argument('--dates', nargs='+', type=int, default=SYNTH_DATES)
+    parser.add_argument('--number-cpu', type=int, default=1)
+    parser.add_argument('--no-kernel', action='store_true', help='force the pure numpy engine')
+    parser.add_argument('--dtype', default='float64', choices=['float64', 'float32'],
+                        help='engine compute dtype for synthetic cubes')
+    parser.add_argument('--out', help='save records to json')
+    parser.add_argument('--compare', help='baseline json to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.no_kernel:
+        algos._ewmacd_kernel = None
+
+    records = []
+    if 'pixel' in args.cases:
+        records += bench_single_pixel()
+    if 'stack' in args.cases:
+        records += bench_stack(args.number_cpu)
+
+    for rec in records:
+        print(_format_record(rec))
+
+    if 'synthetic' in args.cases:
+        records += bench_synthetic(args.sizes, args.dates, dtype=args.dtype)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(records, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressed = compare(records, json.load(f), args.tolerance)
+
+        for name in regressed:
+            print(f'regression: {name}')
+
+        if regressed:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
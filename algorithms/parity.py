@@ -0,0 +1,476 @@
+"""
+Golden-output regression harness for ewmacd on the sample Angle Index
+stack and its DOY table. Goldens are stored in testing/ewmacd_golden.npz
+and every backend (per-pixel reference, numpy cube engine, compiled
+kernel, multi-process, dask, streamed netcdf, float32, parameter sweep and
+incremental update) is validated against the same goldens. Run from the
+repository root, e.g.:
+
+    python -m algorithms.parity
+    python -m algorithms.parity --update --source r
+
+Goldens are meant to come from the original R implementation
+(EWMACD.pixel.for.calc.lt in EWMACD v1.3.0.r, run via Rscript without any
+R packages). Where R is not installed they come from the python per-pixel
+reference instead, and the source is stored with the goldens. The
+committed goldens are from the python reference, as R was not available
+where they were generated, and the R driver below has not been run yet.
+Until they are regenerated with --update --source r, the harness only
+checks the faster backends against the port, not the port against R.
+Known, intended differences of the port to R:
+    - persistence fallback keeps negative values (np.max(v, 0) on a scalar
+      returns v) where R clips at 0 via max(v, 0).
+    - refit after X-bar screening uses the training subset (pix_1[keeps])
+      where R indexes the full series (myPixel[keeps]).
+The per-pixel reference reproduces both with r_compat=True. Pixels where
+that differs from the port are stored with the goldens as known
+differences. With R goldens, those pixels are checked against the port's
+own output (stored too) instead of R, so only unexpected deviations from
+R fail and the faster backends are still checked everywhere. The pixel_r
+backend (the r_compat reference) is expected to match R goldens
+everywhere, and is only run against them.
+"""
+
+import os
+import shutil
+import argparse
+import tempfile
+import subprocess
+import importlib.util
+import numpy as np
+import xarray as xr
+
+from algorithms import algos
+from algorithms import bench
+
+GOLDEN_FILE = os.path.join(bench.ROOT, 'testing', 'ewmacd_golden.npz')
+R_SCRIPT = os.path.join(bench.ROOT, 'EWMACD v1.3.0', 'EWMACD v1.3.0.r')
+
+# training and testing years as per the R examples on the sample stack
+TRAINING_START = 2005
+TRAINING_END = 2009
+TESTING_END = 2012
+
+# parameter combos covered by the goldens, others as per ewmacd defaults
+COMBOS = [
+    {'lam': lam, 'rounding': rounding, 'persistence': persistence}
+    for rounding in (True, False)
+    for persistence in (1, 3, 5)
+    for lam in (0.3, 0.7)
+]
+
+# coded output where the reference could not process a pixel (raised)
+ERROR_CODE = -7777
+
+# max abs difference of unrounded change codes (rounded ewma, in data units) of the
+# float32 backend, where float32 ewma values fall on the other side of a .5
+FLOAT32_TOLERANCE = 1
+
+# backends that can be validated, kernel and dask where installed
+BACKENDS = ['pixel', 'pixel_r', 'numpy', 'kernel', 'parallel', 'dask', 'nc', 'float32', 'sweep', 'update']
+
+# sources only the function definition (the script itself sets a working
+# directory and loads raster), and stubs its plotting call
+R_DRIVER = r'''
+args <- commandArgs(trailingOnly=TRUE)
+for (e in parse(file=args[1])) {
+  if (is.call(e) && length(e) == 3 && identical(e[[2]], as.name('EWMACD.pixel.for.calc.lt'))) eval(e)
+}
+lines <- function(...) invisible(NULL)
+
+pix <- as.matrix(read.csv(args[2], header=FALSE, na.strings='NaN'))
+dates <- read.csv(args[3])
+combos <- read.csv(args[4])
+
+out <- NULL
+for (k in seq_len(nrow(combos))) {
+  cb <- combos[k, ]
+  res <- t(apply(pix, 1, function(p) tryCatch(
+    EWMACD.pixel.for.calc.lt(p, cb$ns, cb$nc, cb$historybound, dates$DOY, cb$xbar_limit_1,
+                             cb$training_start, cb$testing_end, dates$Year, cb$xbar_limit_2,
+                             cb$low_thresh, cb$lam, cb$lam_sigs, as.logical(cb$rounding),
+                             cb$persistence, cb$training_end),
+    error=function(e) rep(-7777, length(p)))))
+  out <- rbind(out, res)
+}
+write.table(out, args[5], sep=',', row.names=FALSE, col.names=FALSE)
+'''
+
+
+def load_sample() -> tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+    """
+    Loads the sample stack subset to the training and testing years.
+    :return: Tuple. Pixel values of (pixels, dates) with NaN where missing,
+    years, doys and index of last training date.
+    """
+
+    arr = bench.read_stack(bench.SAMPLE_STACK)
+    table = bench.read_doy_table(bench.SAMPLE_DOYS)
+    years, doys = table[:, 0], table[:, 3]
+
+    trims = (years >= TRAINING_START) & (years < TESTING_END)
+    pix = arr[:, :, trims].reshape(-1, trims.sum())
+    years, doys = years[trims], doys[trims]
+
+    history_bound = int(np.max(np.where(years < TRAINING_END)))
+
+    return pix, years, doys, history_bound
+
+
+def _combo_params(
+        combo: dict,  # lam, rounding and persistence
+        history_bound: int,
+        doys: np.ndarray
+) -> dict:
+    """
+    Full ewmacd_per_cube parameters for a golden combo.
+    :return: Dict. Keyword arguments.
+    """
+
+    params = dict(bench.PARAMS, history_bound=history_bound, doys=doys)
+    params.update(combo)
+
+    return params
+
+
+def run_python_reference(
+        pix: np.ndarray,  # (pixels, dates)
+        years: np.ndarray,
+        doys: np.ndarray,
+        history_bound: int,
+        combos: list = None,  # defaults to COMBOS
+        r_compat: bool = False
+) -> np.ndarray:
+    """
+    Runs combos through ewmacd_per_pixel, pixel by pixel.
+    :param r_compat: Bool. Reproduce the known differences to R.
+    :return: Numpy Array. Change codes of (combos, pixels, dates), ERROR_CODE
+    where the reference raised.
+    """
+
+    combos = combos or COMBOS
+
+    out = np.full((len(combos),) + pix.shape, ERROR_CODE, dtype='int32')
+    for i, combo in enumerate(combos):
+        p = _combo_params(combo, history_bound, doys)
+        for j in range(len(pix)):
+            try:
+                out[i, j] = algos.ewmacd_per_pixel(pix[j].copy(), p['ns'], p['nc'], history_bound, doys, years,
+                                                   TRAINING_START, TRAINING_END, TESTING_END, p['xbar_limit_1'],
+                                                   p['xbar_limit_2'], p['low_thresh'], p['lam'], p['lam_sigs'],
+                                                   p['rounding'], p['persistence'], r_compat)[3]
+            except Exception:
+                pass
+
+    return out
+
+
+def run_r_reference(
+        pix: np.ndarray,  # (pixels, dates)
+        years: np.ndarray,
+        doys: np.ndarray,
+        history_bound: int
+) -> np.ndarray:
+    """
+    Runs every combo through the original R implementation via Rscript.
+    Inputs and outputs are exchanged as csv in a temporary folder.
+    :return: Numpy Array. Change codes of (combos, pixels, dates), ERROR_CODE
+    where R raised.
+    """
+
+    rscript = shutil.which('Rscript')
+    if rscript is None:
+        raise EnvironmentError('Rscript not found, install R or use --source python.')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = [os.path.join(tmp_dir, f) for f in ['driver.R', 'pix.csv', 'dates.csv', 'combos.csv', 'out.csv']]
+
+        with open(paths[0], 'w') as f:
+            f.write(R_DRIVER)
+
+        np.savetxt(paths[1], pix, delimiter=',', fmt='%.10g')
+        np.savetxt(paths[2], np.column_stack([years, doys]), delimiter=',', fmt='%d',
+                   header='Year,DOY', comments='')
+
+        # r is 1-based, so historybound is one more than the python index
+        with open(paths[3], 'w') as f:
+            f.write('ns,nc,historybound,xbar_limit_1,xbar_limit_2,low_thresh,lam,lam_sigs,rounding,'
+                    'persistence,training_start,training_end,testing_end\n')
+            for combo in COMBOS:
+                p = _combo_params(combo, history_bound, doys)
+                f.write(f"{p['ns']},{p['nc']},{history_bound + 1},{p['xbar_limit_1']},{p['xbar_limit_2']},"
+                        f"{p['low_thresh']},{p['lam']},{p['lam_sigs']},{str(p['rounding']).upper()},"
+                        f"{p['persistence']},{TRAINING_START},{TRAINING_END},{TESTING_END}\n")
+
+        subprocess.run([rscript, paths[0], R_SCRIPT] + paths[1:], check=True)
+
+        out = np.loadtxt(paths[4], delimiter=',', dtype='int32', ndmin=2)
+
+    return out.reshape((len(COMBOS),) + pix.shape)
+
+
+def find_known_differences(
+        pix: np.ndarray,  # (pixels, dates)
+        years: np.ndarray,
+        doys: np.ndarray,
+        history_bound: int,
+        port: np.ndarray = None  # change codes of the port, if already run
+) -> np.ndarray:
+    """
+    Flags pixels hit by the known differences of the port to R, i.e., where
+    the per-pixel reference differs with and without r_compat.
+    :return: Numpy Array. Bool mask of (combos, pixels).
+    """
+
+    if port is None:
+        port = run_python_reference(pix, years, doys, history_bound)
+
+    r_like = run_python_reference(pix, years, doys, history_bound, r_compat=True)
+
+    return (port != r_like).any(axis=2)
+
+
+def update_goldens(
+        source: str = 'r'  # r or python
+) -> None:
+    """
+    Regenerates the goldens from the R or python reference and saves them,
+    with their source and known differences to R, to GOLDEN_FILE.
+    :param source: String. Reference implementation, 'r' or 'python'.
+    """
+
+    pix, years, doys, history_bound = load_sample()
+
+    if source not in ['r', 'python']:
+        raise ValueError('Source must be r or python.')
+
+    port = run_python_reference(pix, years, doys, history_bound)
+    known = find_known_differences(pix, years, doys, history_bound, port)
+
+    # port output is only stored separately when the goldens are from r
+    extra = {}
+    if source == 'r':
+        chng = run_r_reference(pix, years, doys, history_bound)
+        extra['port'] = port.astype('int16')
+    else:
+        chng = port
+
+    # change codes are small ints, int16 keeps the stored goldens compact
+    if np.abs(chng).max() > np.iinfo('int16').max or np.abs(port).max() > np.iinfo('int16').max:
+        raise ValueError('Change codes exceed int16 range.')
+
+    np.savez_compressed(GOLDEN_FILE,
+                        chng=chng.astype('int16'),
+                        known=known,
+                        source=source,
+                        **extra,
+                        lam=[c['lam'] for c in COMBOS],
+                        rounding=[c['rounding'] for c in COMBOS],
+                        persistence=[c['persistence'] for c in COMBOS])
+
+
+def _to_cube(
+        pix: np.ndarray,  # (pixels, dates)
+        years: np.ndarray,
+        doys: np.ndarray
+) -> xr.Dataset:
+    """
+    Sample pixels as an ndvi cube of (time, y, x), one pixel per row, on the
+    datetime64 dates of their years and doys, for the xarray backends.
+    :return: Xarray Dataset. Ndvi cube.
+    """
+
+    times = (years - 1970).astype('datetime64[Y]').astype('datetime64[D]') + (doys - 1)
+
+    return xr.Dataset({'ndvi': (('time', 'y', 'x'), pix.T[:, :, None])},
+                      coords={'time': times, 'y': np.arange(len(pix)), 'x': [0]})
+
+
+def _ewmacd_kwargs(
+        combo: dict  # lam, rounding and persistence
+) -> dict:
+    """
+    Full ewmacd parameters for a golden combo.
+    :return: Dict. Keyword arguments.
+    """
+
+    params = dict(bench.PARAMS, **combo)
+
+    return {
+        'training_start': TRAINING_START,
+        'training_end': TRAINING_END,
+        'testing_end': TESTING_END,
+        'number_harmonics': params['ns'],
+        'xbar_limit_1': params['xbar_limit_1'],
+        'xbar_limit_2': params['xbar_limit_2'],
+        'low_thresh': params['low_thresh'],
+        'lam': params['lam'],
+        'lam_sigs': params['lam_sigs'],
+        'rounding': params['rounding'],
+        'persistence': params['persistence']
+    }
+
+
+def _backends() -> dict:
+    """
+    Available backends to validate, each a callable of (pix, years, doys,
+    history_bound, combo) returning change codes of (pixels, dates).
+    :return: Dict. Backend name and callable.
+    """
+
+    def run_pixel(pix, years, doys, history_bound, combo):
+        return run_python_reference(pix, years, doys, history_bound, [combo])[0]
+
+    def run_pixel_r(pix, years, doys, history_bound, combo):
+        return run_python_reference(pix, years, doys, history_bound, [combo], r_compat=True)[0]
+
+    def run_numpy(pix, years, doys, history_bound, combo):
+        kernel, algos._ewmacd_kernel = algos._ewmacd_kernel, None
+        try:
+            return algos.ewmacd_per_cube(pix, **_combo_params(combo, history_bound, doys))[0]
+        finally:
+            algos._ewmacd_kernel = kernel
+
+    def run_kernel(pix, years, doys, history_bound, combo):
+        return algos.ewmacd_per_cube(pix, **_combo_params(combo, history_bound, doys))[0]
+
+    def run_parallel(pix, years, doys, history_bound, combo):
+        params = _combo_params(combo, history_bound, doys)
+        return algos.ewmacd_per_cube_parallel(pix, 2, tile_size=len(pix) // 4 + 1, **params)[0]
+
+    def run_dask(pix, years, doys, history_bound, combo):
+        ds = _to_cube(pix, years, doys).chunk({'y': len(pix) // 4 + 1})
+        ds_out = algos.ewmacd(ds, number_cpu=1, **_ewmacd_kwargs(combo))
+        return ds_out['chng'].values[:, :, 0].T
+
+    def run_nc(pix, years, doys, history_bound, combo):
+        params = _combo_params(combo, history_bound, doys)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_nc = os.path.join(tmp_dir, 'ewmacd.nc')
+            algos.ewmacd_to_nc(_to_cube(pix, years, doys)['ndvi'], out_nc, 2, tile_size=len(pix) // 4 + 1,
+                               **params)
+            with xr.open_dataset(out_nc) as ds_out:
+                return ds_out['chng'].values[:, :, 0].T
+
+    def run_float32(pix, years, doys, history_bound, combo):
+        return algos.ewmacd_per_cube(pix, dtype='float32', **_combo_params(combo, history_bound, doys))[0]
+
+    def run_sweep(pix, years, doys, history_bound, combo):
+        params = _combo_params(combo, history_bound, doys)
+        grid = {k: sorted({c[k] for c in COMBOS}) for k in ['lam', 'rounding', 'persistence']}
+        out = algos.ewmacd_sweep_per_cube(pix, params['ns'], params['nc'], history_bound, doys,
+                                          params['xbar_limit_1'], params['xbar_limit_2'], params['low_thresh'],
+                                          grid['lam'], [params['lam_sigs']], grid['rounding'],
+                                          grid['persistence'])
+        return out[grid['lam'].index(combo['lam']), 0, grid['rounding'].index(combo['rounding']),
+                   grid['persistence'].index(combo['persistence'])]
+
+    # state of the training dates, then every testing date appended one by one
+    def run_update(pix, years, doys, history_bound, combo):
+        params = _combo_params(combo, history_bound, doys)
+        params['doys'] = doys[:history_bound + 1]
+        state = algos.ewmacd_per_cube(pix[:, :history_bound + 1], return_state=True, **params)[-1]
+        for t in range(history_bound + 1, pix.shape[1]):
+            algos.ewmacd_update(state, pix[:, t], doys[t])
+        return state['chng'][:, :state['num_dates']]
+
+    backends = {
+        'pixel': run_pixel,
+        'pixel_r': run_pixel_r,
+        'numpy': run_numpy,
+        'parallel': run_parallel,
+        'nc': run_nc,
+        'float32': run_float32,
+        'sweep': run_sweep,
+        'update': run_update
+    }
+    if algos._ewmacd_kernel is not None:
+        backends['kernel'] = run_kernel
+    if importlib.util.find_spec('dask') is not None:
+        backends['dask'] = run_dask
+
+    return backends
+
+
+def check(
+        backends: list = None  # names of backends, defaults to all
+) -> dict:
+    """
+    Validates backends against the goldens. Pixels the reference could not
+    process (ERROR_CODE) are skipped, as the engine reports -2222 there.
+    With R goldens, known differences of the port to R (see
+    find_known_differences) are checked against the port's output instead,
+    except for pixel_r, which reproduces them. With python goldens, there
+    are no known differences to skip and pixel_r is not run. Unrounded
+    float32 codes may differ by up to FLOAT32_TOLERANCE.
+    :param backends: List of Strings. Names of backends, defaults to all.
+    :return: Dict. Backend name and list of mismatched pixel counts per combo.
+    """
+
+    golden = np.load(GOLDEN_FILE)
+    chng, source = golden['chng'], str(golden['source'])
+
+    pix, years, doys, history_bound = load_sample()
+    if chng.shape[1:] != pix.shape or 'known' not in golden or (source == 'r' and 'port' not in golden):
+        raise ValueError('Goldens do not match sample stack, regenerate with --update.')
+
+    # expected change codes of the port, r goldens with the known differences taken from the port
+    expected = np.where(golden['known'][:, :, None], golden['port'], chng) if source == 'r' else chng
+
+    available = _backends()
+    backends = [name for name in backends or list(available) if name != 'pixel_r' or source == 'r']
+
+    missing = sorted(set(backends) - set(available))
+    if missing:
+        raise ValueError(f'Backends not available, missing optional packages: {missing}.')
+
+    results = {}
+    for name in backends:
+        refs = chng if name == 'pixel_r' else expected
+
+        results[name] = []
+        for combo, ref in zip(COMBOS, refs):
+            out = available[name](pix, years, doys, history_bound, combo)
+            tol = FLOAT32_TOLERANCE if name == 'float32' and not combo['rounding'] else 0
+            is_ok = (ref == ERROR_CODE).all(axis=1) | (np.abs(out.astype(int) - ref) <= tol).all(axis=1)
+            results[name].append(int((~is_ok).sum()))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Validate ewmacd backends against golden outputs.')
+    parser.add_argument('--update', action='store_true', help='regenerate goldens')
+    parser.add_argument('--source', default='r', choices=['r', 'python'])
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS)
+    args = parser.parse_args()
+
+    if args.update:
+        update_goldens(args.source)
+        print(f'goldens updated from {args.source} reference: {GOLDEN_FILE}')
+        return
+
+    source = str(np.load(GOLDEN_FILE)['source'])
+    if source != 'r':
+        print(f'warning: goldens are from the {source} reference, not R, so this is no check of R parity, '
+              f'only of the backends against the port. Regenerate where R is installed with --update --source r.')
+
+    results = check(args.backends)
+
+    for name, counts in results.items():
+        for combo, num in zip(COMBOS, counts):
+            print(f'{name:<9} goldens={source:<7} {combo} mismatched pixels {num}')
+
+    if source == 'r':
+        known = np.load(GOLDEN_FILE)['known']
+        print(f'known differences to R checked against the port: {int(known.sum())} of {known.size} pixels '
+              f'over all combos')
+    elif args.backends is None or 'pixel_r' in args.backends:
+        print('pixel_r not run, it reproduces R and needs R goldens')
+
+    if any(sum(counts) for counts in results.values()):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""
+Headless batch refresh of ewmacd for every site saved in sites.json, for
+unattended (e.g., nightly) monitoring without the gui. Sites are refreshed
+on a process pool, one site per worker, and each site's results are
+written back to sites.json as soon as that site finishes, so a failing or
+killed run keeps every site completed before it. Site cubes can first be
+updated with scenes newer than their last date. Run from the repository
+root, e.g.:
+
+    python batch.py C:/mon/output/sites.json --number-cpu all --maps --update-cubes
+"""
+
+import os
+import json
+import argparse
+import pandas as pd
+import xarray as xr
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+
+from algorithms import algos
+from dea import shared
+from dea import downloader
+
+# date format of algo_xs_date in sites.json, as per SitesModel
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# ndvi is scaled in the engine, as per NewSite
+NDVI_SCALE = 10000
+
+
+def load_sites(in_json: str) -> list[dict]:
+    """
+    Loads saved sites from a sites.json file.
+    :param in_json: String. Path to sites.json.
+    :return: List of Dicts. Sites as saved by SitesModel.
+    """
+
+    with open(in_json, 'r') as f:
+        sites = json.load(f)
+
+    return sites or []
+
+
+def save_sites(
+        sites: list[dict],
+        out_json: str
+) -> None:
+    """
+    Saves sites to a sites.json file, see shared.atomic_write.
+    :param sites: List of Dicts. Sites as saved by SitesModel.
+    :param out_json: String. Path to sites.json.
+    """
+
+    with shared.atomic_write(out_json) as tmp_json:
+        with open(tmp_json, 'w') as f:
+            json.dump(sites, f)
+
+
+def _open_site_ndvi(nc_file: str) -> xr.Dataset:
+    """
+    Opens a site cube lazily and adds ndvi, as per NewSite.
+    :param nc_file: String. Path to site cube netcdf.
+    :return: Xarray Dataset. Site cube with ndvi variable.
+    """
+
+    ds = xr.open_dataset(nc_file, chunks={'time': -1, 'y': 'auto', 'x': 'auto'})  # as per downloader
+    ds['ndvi'] = ((ds['nir_1'] - ds['red']) / (ds['nir_1'] + ds['red']))
+
+    return ds
+
+
+def update_site_cube(site: dict) -> None:
+    """
+    Appends scenes newer than the last date of a saved site's cube netcdf,
+    see downloader.download_new_site_cube. Progress messages are printed.
+    :param site: Dict. Site as saved by SitesModel.
+    """
+
+    if not site.get('polygon'):
+        raise ValueError(f"Site {site['id']} has no polygon to update its cube with.")
+
+    def print_text(msg):
+        print(f"site {site['id']}: {msg.strip()}", flush=True)
+
+    ds = downloader.download_new_site_cube(in_poly=site['polygon'],
+                                           out_nc=site['nc_file'],
+                                           stac_cb_fn=lambda val: None,
+                                           mask_cb_fn=lambda val: None,
+                                           band_cb_fn=lambda val: None,
+                                           text_cb_fn=print_text,
+                                           update=True)
+    ds.close()
+
+
+def refresh_site(
+        site: dict,
+        out_folder: str,
+        write_map: bool = False,
+        update_cube: bool = False
+) -> dict:
+    """
+    Reruns ewmacd for one saved site on its cube netcdf. The median series
+    is run as per NewSite and, if write_map, the per-pixel change map is
+    streamed to ewmacd_<id>.nc in out_folder (resumed if a previous run of
+    the same inputs was interrupted, otherwise replaced).
+    :param site: Dict. Site as saved by SitesModel.
+    :param out_folder: String. Folder for change map netcdfs.
+    :param write_map: Bool. Write the per-pixel change map too.
+    :param update_cube: Bool. Append new scenes to the cube netcdf first.
+    :return: Dict. Updated algo_* values of the site, in sites.json format.
+    """
+
+    if not site.get('nc_file') or not os.path.exists(site['nc_file']):
+        raise FileNotFoundError(f"Site {site['id']} has no cube netcdf: {site.get('nc_file')}.")
+
+    if update_cube:
+        update_site_cube(site)
+
+    params = {
+        'training_start': site['train_start'],
+        'training_end': site['train_end'],
+        'testing_end': site['test_end'],
+        'number_harmonics': site['num_harmonics'],
+        'xbar_limit_1': site['xbar_limit_1'],
+        'xbar_limit_2': site['xbar_limit_2'],
+        'low_thresh': site['low_thresh'],
+        'lam': site['lambda_value'],
+        'lam_sigs': site['lambda_stdvs'],
+        'rounding': site['rounding'],
+        'persistence': site['persistence'],
+        'scale': NDVI_SCALE
+    }
+
+    ds = _open_site_ndvi(site['nc_file'])
+    try:
+        if write_map:
+            out_nc = os.path.join(out_folder, f"ewmacd_{site['id']}.nc")
+            algos.ewmacd(ds[['ndvi']], number_cpu=1, write_file=True, file_name=out_nc, overwrite=True, **params)
+
+        ds_med = ds[['ndvi']].median(['x', 'y']).load()  # only the median series is read into memory
+
+    finally:
+        ds.close()
+
+    ds_ewm = algos.ewmacd(ds_med, number_cpu=1, **params)
+
+    # fit for present dates only, change for all dates, ndvi and fit in engine units, as per NewSite
+    is_present = ds_ewm['ndvi'].notnull().values
+    dates = pd.DatetimeIndex(ds_ewm['time'].values[is_present]).normalize()
+
+    out = {
+        'algo_xs_date': list(dates.strftime(DATE_FORMAT)),
+        'algo_ys_vege': (ds_ewm['ndvi'].values[is_present].astype(float) * NDVI_SCALE).tolist(),
+        'algo_ys_harm': (ds_ewm['harm'].values[is_present].astype(float) * NDVI_SCALE).tolist(),
+        'algo_ys_chng': ds_ewm['chng'].values.astype(float).tolist()
+    }
+
+    return out
+
+
+def run(
+        in_json: str,
+        number_cpu=1,  # int or 'all'
+        write_map: bool = False,
+        site_ids: list = None,
+        update_cube: bool = False
+) -> dict:
+    """
+    Refreshes ewmacd for all (or the selected) sites in a sites.json file
+    across a process pool, writing each site's results back to the file as
+    it finishes. Errors are recorded per site and do not stop the run.
+    :param in_json: String. Path to sites.json.
+    :param number_cpu: Int or 'all'. Number of worker processes.
+    :param write_map: Bool. Write per-pixel change maps next to sites.json.
+    :param site_ids: List of Ints. Ids of sites to refresh, defaults to all.
+    :param update_cube: Bool. Append new scenes to each site's cube first.
+    :return: Dict. Site id and error message, None where refreshed.
+    """
+
+    if number_cpu == 'all':
+        number_cpu = os.cpu_count()
+
+    sites = load_sites(in_json)
+    todo = [site for site in sites if site_ids is None or site['id'] in site_ids]
+
+    out_folder = os.path.dirname(os.path.abspath(in_json))
+    status = {}
+
+    with ProcessPoolExecutor(max_workers=max(1, min(int(number_cpu), len(todo) or 1))) as pool:
+        futures = {}
+        for site in todo:
+            task = pool.submit(refresh_site, site, out_folder, write_map, update_cube)
+            futures[task] = site
+
+        for future in as_completed(futures):
+            site = futures[future]
+            try:
+                site.update(future.result())
+                status[site['id']] = None
+            except Exception as e:
+                status[site['id']] = f'{type(e).__name__}: {e}'
+                print(f"site {site['id']} ({site.get('code')}) failed: {status[site['id']]}", flush=True)
+                continue
+
+            save_sites(sites, in_json)
+            print(f"site {site['id']} ({site.get('code')}) refreshed", flush=True)
+
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Refresh ewmacd for all saved sites without the gui.')
+    parser.add_argument('sites_json', help='path to sites.json')
+    parser.add_argument('--number-cpu', default='1', help="worker processes, or 'all'")
+    parser.add_argument('--maps', action='store_true', help='also write per-pixel change map netcdfs')
+    parser.add_argument('--sites', nargs='+', type=int, help='ids of sites to refresh, defaults to all')
+    parser.add_argument('--update-cubes', action='store_true', help='first append new scenes to site cubes')
+    args = parser.parse_args()
+
+    number_cpu = args.number_cpu if args.number_cpu == 'all' else int(args.number_cpu)
+    status = run(args.sites_json, number_cpu, args.maps, args.sites, args.update_cubes)
+
+    failed = [k for k, v in status.items() if v is not None]
+    print(f'{len(status) - len(failed)} of {len(status)} sites refreshed')
+
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
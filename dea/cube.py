@@ -11,6 +11,8 @@ import rioxarray as rxr
 from typing import Union
 from osgeo import gdal
 
+from dea import shared
+
 gdal.SetConfigOption('GDAL_HTTP_UNSAFESSL', 'YES')
 gdal.SetConfigOption('CPL_VSIL_CURL_ALLOWED_EXTENSIONS', '.tif')
 gdal.SetConfigOption('GDAL_HTTP_CONNECTTIMEOUT', '30')
@@ -662,6 +664,58 @@ def export_xr_to_nc(ds: xr.Dataset, out_nc: str) -> None:
         raise e
 
 
+def get_last_nc_date(in_nc: str) -> Union[str, None]:
+    """
+    Reads the date of the last time slice in an existing NetCDF.
+    :param in_nc: NetCDF file path.
+    :return: Date as a string (YYYY-MM-DD) or None if NetCDF has no times.
+    """
+
+    with xr.open_dataset(in_nc) as ds:
+        if 'time' not in ds.dims or ds.sizes['time'] == 0:
+            return None
+
+        dt = pd.to_datetime(ds['time'].values.max())
+
+    return dt.strftime('%Y-%m-%d')
+
+
+def append_xr_to_nc(ds: xr.Dataset, out_nc: str) -> None:
+    """
+    Appends the time slices of a Xarray Dataset (e.g., newly downloaded
+    scenes, prepared as per export_xr_to_nc) to an existing NetCDF. Only
+    slices after the last existing time are added and both must share the
+    same x and y grid. The combined data is written via
+    shared.atomic_write.
+    :param ds: Xarray Dataset of new time slices.
+    :param out_nc: Existing NetCDF file path.
+    :return: None.
+    """
+
+    # raw values, as per fix_xr_meta_and_combine, so old and new slices match
+    ds_old = xr.open_dataset(out_nc, mask_and_scale=False, chunks={})
+
+    try:
+        for dim in ['x', 'y']:
+            if ds_old.sizes[dim] != ds.sizes[dim] or not np.allclose(ds_old[dim], ds[dim]):
+                raise ValueError(f'New data does not match {dim} grid of existing NetCDF.')
+
+        ds = ds.sel(time=ds['time'] > ds_old['time'].max())
+        if ds.sizes['time'] == 0:
+            return
+
+        ds_all = xr.concat([ds_old, ds], dim='time')
+        ds_all.attrs = ds_old.attrs
+
+        # existing netcdf is closed before it is swapped out
+        with shared.atomic_write(out_nc) as tmp_nc:
+            ds_all.to_netcdf(tmp_nc)
+            ds_old.close()
+
+    finally:
+        ds_old.close()
+
+
 def safe_close_ncs(tmp_folder: str) -> None:
     """
     Combining NetCDFs with dask seems to keep some NetCDFs open
@@ -1,24 +1,92 @@
 
 import os
 import shutil
-import time
 import datetime
 import shapely
 import geopandas as gpd
 import xarray as xr
 
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures import as_completed
+from concurrent.futures import wait
+from concurrent.futures import FIRST_COMPLETED
 
 from dea import stac, cube
 
+
+def download_masks_then_bands(
+        downloads: list[cube.Download],
+        max_threads: int,
+        mask_cb_fn,  #: float,
+        band_cb_fn,  #: float,
+        text_cb_fn  #: str
+) -> None:
+    """
+    Downloads and validates the mask of each download and, as soon as its
+    mask is valid, its bands, on one bounded thread pool. Whenever a thread
+    frees up, bands of validated downloads are started before further masks,
+    so mask and band requests overlap instead of all bands waiting on the
+    last mask. Downloads are flagged in place, see cube.Download.
+    :param downloads: List of Download objects.
+    :param max_threads: Integer representing max concurrent requests.
+    :param mask_cb_fn: Mask progress callback, percent of masks done.
+    :param band_cb_fn: Band progress callback, percent of bands done of
+    those validated or still to validate.
+    :param text_cb_fn: Message callback.
+    :return: None.
+    """
+
+    todo_masks = deque(downloads)
+    todo_bands = deque()
+
+    mask_cb_fn(0)
+    band_cb_fn(0)
+
+    num_masks, num_valid, num_bands = 0, 0, 0
+    with ThreadPoolExecutor(max_workers=max_threads) as pool:
+        running = {}
+        while todo_masks or todo_bands or running:
+            while len(running) < max_threads and (todo_bands or todo_masks):
+                if todo_bands:
+                    download = todo_bands.popleft()
+                    task = pool.submit(cube.worker_read_bands_and_export, download)
+                    running[task] = ('band', download)
+                else:
+                    download = todo_masks.popleft()
+                    task = pool.submit(cube.worker_read_mask_and_validate, download)
+                    running[task] = ('mask', download)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                stage, download = running.pop(future)
+
+                msg = '-' + ' ' + future.result()
+                text_cb_fn(msg)
+
+                if stage == 'mask':
+                    num_masks += 1
+                    mask_cb_fn(num_masks / len(downloads) * 100)
+
+                    if download.is_mask_valid() is True:
+                        num_valid += 1
+                        todo_bands.append(download)
+                else:
+                    num_bands += 1
+
+                # bands still to come are those of valid masks, and at most all masks left
+                num_bands_max = num_valid + len(downloads) - num_masks
+                band_cb_fn(num_bands / max(num_bands_max, 1) * 100)
+
+
 def download_new_site_cube(
         in_poly: list,
         out_nc: str,
         stac_cb_fn,  #: float,
         mask_cb_fn,  #: float,
         band_cb_fn,  #: float,
-        text_cb_fn  #: str
+        text_cb_fn,  #: str
+        update: bool = False  # only append scenes newer than an existing out_nc
 ) -> xr.Dataset:
 
     # set up parameters
@@ -68,7 +136,11 @@ def download_new_site_cube(
     # max_threads = shared.prepare_max_threads(in_max_threads)  # if user gave none, uses max cpus - 1
     max_threads = 8
 
-    time.sleep(1)
+    # when updating, only scenes after the last one already in the site cube are downloaded
+    last_date = None
+    if update and os.path.exists(out_nc):
+        last_date = cube.get_last_nc_date(out_nc)
+        text_cb_fn(f'Updating site cube with scenes after {last_date}...')
 
     # endregion
 
@@ -80,12 +152,14 @@ def download_new_site_cube(
         stac_cb_fn(0)
 
         # reproject stac bbox to wgs 1984, fetch all available stac items
+        # cached next to out_nc, so reruns only query dates since the last run
         stac_bbox = fc_bbox
         stac_features = stac.fetch_all_stac_feats(collections,
                                                   start_date,
                                                   end_date,
                                                   stac_bbox,
-                                                  100)
+                                                  100,
+                                                  cache_folder=os.path.join(os.path.dirname(out_nc), 'stac_cache'))
 
         stac_cb_fn(100)
 
@@ -98,8 +172,6 @@ def download_new_site_cube(
         text_cb_fn('No STAC features were found.')
         raise  # return
 
-    time.sleep(1)
-
     # endregion
 
     # region PREPARING STAC FEATURES
@@ -109,6 +181,10 @@ def download_new_site_cube(
     root_folder = os.path.dirname(out_nc)
     tmp_folder = os.path.join(root_folder, 'tmp')
 
+    # per site when updating, so sites in the same folder can update at once
+    if update:
+        tmp_folder = os.path.splitext(out_nc)[0] + '_tmp'
+
     if os.path.exists(tmp_folder):
         shutil.rmtree(tmp_folder)
 
@@ -142,78 +218,47 @@ def download_new_site_cube(
 
     stac_downloads = stac.group_stac_downloads_by_solar_day(stac_downloads)
 
+    if last_date is not None:
+        stac_downloads = [d for d in stac_downloads if d.get_date() > last_date]
+
+        if len(stac_downloads) == 0:
+            text_cb_fn('No new scenes were found, site cube is up to date.')
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+            return xr.open_dataset(out_nc, chunks={'time': -1, 'y': 'auto', 'x': 'auto'})
+
     if len(stac_downloads) == 0:
         text_cb_fn('No valid downloads were found.')
         raise
 
-    time.sleep(1)
-
     # endregion
 
-    # region DOWNLOAD WCS MASK DATA
+    # region DOWNLOAD WCS MASK DATA, THEN VALID DATA
 
-    text_cb_fn('\n' + 'Downloading and validating mask data...')
+    text_cb_fn('\n' + 'Downloading and validating mask data, then valid data...')
 
     try:
-        mask_cb_fn(0)
-        i = 0
-        with ThreadPoolExecutor(max_workers=max_threads) as pool:
-            futures = []
-            for stac_download in stac_downloads:
-                task = pool.submit(cube.worker_read_mask_and_validate, stac_download)
-                futures.append(task)
-
-            for future in as_completed(futures):
-                msg = '-' + ' ' + future.result()
-                text_cb_fn(msg)
-
-                i += 1
-                if i % 1 == 0:
-                    mask_cb_fn((i / len(stac_downloads) * 100))
+        download_masks_then_bands(stac_downloads,
+                                  max_threads,
+                                  mask_cb_fn,
+                                  band_cb_fn,
+                                  text_cb_fn)
 
     except Exception as e:
-        text_cb_fn('Error occurred while downloading and validating mask data.')
+        text_cb_fn('Error occurred while downloading mask or valid data. See messages.')
         text_cb_fn(str(e))
-        raise
+        raise  # return
 
     stac_downloads = cube.remove_mask_invalid_downloads(stac_downloads)
 
+    if last_date is not None and len(stac_downloads) == 0:
+        text_cb_fn('No new valid scenes were found, site cube is up to date.')
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        return xr.open_dataset(out_nc, chunks={'time': -1, 'y': 'auto', 'x': 'auto'})
+
     if len(stac_downloads) == 0:
         text_cb_fn('No valid downloads were found.')
         raise
 
-    time.sleep(1)
-
-    # endregion
-
-    # region DOWNLOAD WCS VALID DATA
-
-    text_cb_fn('\n' + 'Downloading valid data...')
-
-    try:
-        band_cb_fn(0)
-        i = 0
-        with ThreadPoolExecutor(max_workers=max_threads) as pool:
-            futures = []
-            for download in stac_downloads:
-                task = pool.submit(cube.worker_read_bands_and_export, download)
-                futures.append(task)
-
-            for future in as_completed(futures):
-                msg = '-' + ' ' + future.result()
-                text_cb_fn(msg)
-
-                i += 1
-                if i % 1 == 0:
-                    band_cb_fn((i / len(stac_downloads) * 100))
-
-    except Exception as e:
-        text_cb_fn('Error occurred while downloading valid data. See messages.')
-        text_cb_fn(str(e))
-        raise  # return
-
-    time.sleep(1)
-
     # endregion
 
     # region CLEAN AND COMBINE NETCDFS
@@ -228,8 +273,6 @@ def download_new_site_cube(
         text_cb_fn(str(e))
         raise  # return
 
-    time.sleep(1)
-
     # endregion
 
     # region MASK OUT INVALID NETCDF PIXELS
@@ -247,8 +290,6 @@ def download_new_site_cube(
         text_cb_fn(str(e))
         raise # return
 
-    time.sleep(1)
-
     # endregion
 
     # region EXPORT COMBINED NETCDF
@@ -256,16 +297,19 @@ def download_new_site_cube(
     text_cb_fn('Exporting combined NetCDF...')
 
     try:
-        ds.load()
-        cube.export_xr_to_nc(ds, out_nc)
+        # export (or append to existing cube) streams dask chunks to disk, then reopen lazily with time whole
+        if last_date is not None:
+            cube.append_xr_to_nc(ds, out_nc)
+        else:
+            cube.export_xr_to_nc(ds, out_nc)
+
+        ds = xr.open_dataset(out_nc, chunks={'time': -1, 'y': 'auto', 'x': 'auto'})
 
     except Exception as e:
         text_cb_fn('Error occurred while exporting combined NetCDF. See messages.')
         text_cb_fn(str(e))
         raise # return
 
-    time.sleep(1)
-
     # endregion
 
     # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -282,8 +326,6 @@ def download_new_site_cube(
     except:
         pass
 
-    time.sleep(1)
-
     text_cb_fn('\n' + 'Finished!')
 
     # endregion
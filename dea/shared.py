@@ -0,0 +1,26 @@
+
+import os
+import contextlib
+
+
+@contextlib.contextmanager
+def atomic_write(out_file: str):
+    """
+    Yields a temporary path beside out_file to write to, which is then
+    swapped in for out_file, so an interrupted write never leaves a broken
+    file. The temporary file is removed if writing fails.
+    :param out_file: String. Path of file to (over)write.
+    :return: String. Temporary path to write to.
+    """
+
+    tmp_file = out_file + '.tmp'
+
+    try:
+        yield tmp_file
+
+    except BaseException as e:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise e
+
+    os.replace(tmp_file, out_file)
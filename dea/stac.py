@@ -1,10 +1,30 @@
 
+import os
+import json
+import time
+import hashlib
+import datetime
 import requests
 #import arcpy
 
 from typing import Union
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 
 from dea import cube
+from dea import shared
+
+# max num of concurrent stac queries (and pooled keep-alive connections)
+MAX_THREADS = 8
+
+# num of days per date-sliced stac sub-query, pages of each slice are followed in sequence
+SLICE_DAYS = 365
+
+# dea stac search endpoint, can be pointed at another (e.g., local stand-in) stac server
+STAC_URL = 'https://explorer.sandbox.dea.ga.gov.au/stac/search'
+
+# max age in seconds of a cached stac result before it is queried again in full
+STAC_CACHE_TTL = 7 * 24 * 60 * 60
 
 
 def build_stac_query_url(
@@ -27,7 +47,7 @@ def build_stac_query_url(
     :return: String representing STAC query url.
     """
 
-    url = 'https://explorer.sandbox.dea.ga.gov.au/stac/search?'
+    url = f'{STAC_URL}?'
     url += f'&collection={collection}'
     url += f'&time={start_date}/{end_date}'
     url += f'&bbox={",".join(map(str, bbox))}'
@@ -37,18 +57,77 @@ def build_stac_query_url(
     return url
 
 
-def query_stac_endpoint(stac_url: str) -> list[dict]:
+def make_stac_session(max_threads: int = MAX_THREADS) -> requests.Session:
+    """
+    Creates a requests session with a keep-alive connection pool large
+    enough for max_threads concurrent queries, so pages and sub-queries
+    reuse open connections instead of a new handshake per request.
+    :param max_threads: Integer representing max concurrent queries.
+    :return: Requests Session.
+    """
+
+    adapter = HTTPAdapter(pool_connections=max_threads, pool_maxsize=max_threads)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+
+def split_date_range(
+        start_date: str,
+        end_date: str,
+        num_days: int = SLICE_DAYS
+) -> list[tuple[str, str]]:
+    """
+    Splits a query date range into consecutive sub-ranges of num_days days
+    each, so they can be queried in parallel. Adjacent sub-ranges share
+    their boundary date, so no date is missed however the endpoint treats
+    the end of a range (duplicates are dropped when merging).
+    :param start_date: String representing query start date (YYYY-MM-DD).
+    :param end_date: String representing query end date (YYYY-MM-DD).
+    :param num_days: Integer representing days per sub-range.
+    :return: List of tuples of start and end date strings (YYYY-MM-DD).
+    """
+
+    start = datetime.date.fromisoformat(str(start_date)[:10])
+    end = datetime.date.fromisoformat(str(end_date)[:10])
+
+    ranges = []
+    while True:
+        stop = min(start + datetime.timedelta(days=num_days), end)
+        ranges.append((start.isoformat(), stop.isoformat()))
+
+        if stop >= end:
+            break
+
+        start = stop
+
+    return ranges
+
+
+def query_stac_endpoint(
+        stac_url: str,
+        session: requests.Session = None
+) -> list[dict]:
     """
     Takes a single DEA STAC endpoint query url and returns all available features
     found for the search parameters.
     :param stac_url: String containing a valid DEA STAC endpoint query url.
+    :param session: Requests Session to query with, e.g., shared by threads.
+    Defaults to None, in which case one is created for this query's pages.
     :return: List of dictionaries representing returned STAC metadata.
     """
 
+    if session is None:
+        with requests.Session() as session:
+            return query_stac_endpoint(stac_url, session)
+
     features = []
     while stac_url:
         try:
-            with requests.get(stac_url) as response:
+            with session.get(stac_url) as response:
                 response.raise_for_status()
                 result = response.json()
 
@@ -67,40 +146,215 @@ def query_stac_endpoint(stac_url: str) -> list[dict]:
     return features
 
 
+def _stac_cache_path(
+        cache_folder: str,
+        collection: str,
+        bbox: tuple[float, float, float, float],
+        start_date: str
+) -> str:
+    """
+    Path of the cached STAC result for a collection, bbox and query start
+    date on the current STAC endpoint.
+    :param cache_folder: String representing STAC cache folder.
+    :param collection: String representing a DEA collection name.
+    :param bbox: Tuple of coordinates representing query bbox.
+    :param start_date: String representing query start date (YYYY-MM-DD).
+    :return: String representing cache file path.
+    """
+
+    key = json.dumps([STAC_URL, collection, [round(float(v), 6) for v in bbox], start_date])
+    name = hashlib.sha1(key.encode()).hexdigest()
+
+    return os.path.join(cache_folder, f'{collection}_{name}.json')
+
+
+def load_stac_cache(
+        cache_path: str,
+        ttl: float = STAC_CACHE_TTL
+) -> Union[dict, None]:
+    """
+    Loads a cached STAC result. Results first queried more than ttl seconds
+    ago are evicted (deleted) and treated as missing, so they are queried
+    again in full.
+    :param cache_path: String representing cache file path.
+    :param ttl: Float representing max age of a cached result in seconds.
+    :return: Dictionary of cached result or None if missing or evicted.
+    """
+
+    if not os.path.exists(cache_path):
+        return None
+
+    try:
+        with open(cache_path, 'r') as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        entry = None  # unreadable, e.g., interrupted write
+
+    if entry is None or time.time() - entry.get('created', 0) > ttl:
+        os.remove(cache_path)
+        return None
+
+    return entry
+
+
+def save_stac_cache(
+        cache_path: str,
+        entry: dict
+) -> None:
+    """
+    Saves a STAC result to the cache, see shared.atomic_write.
+    :param cache_path: String representing cache file path.
+    :param entry: Dictionary of STAC result to cache.
+    """
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    with shared.atomic_write(cache_path) as tmp_path:
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+
+
+def clean_stac_cache(
+        cache_folder: str,
+        ttl: float = STAC_CACHE_TTL
+) -> int:
+    """
+    Evicts all cached STAC results older than ttl seconds from a folder.
+    :param cache_folder: String representing STAC cache folder.
+    :param ttl: Float representing max age of a cached result in seconds.
+    :return: Integer representing num of evicted results.
+    """
+
+    if not os.path.exists(cache_folder):
+        return 0
+
+    num_removed = 0
+    for file in os.listdir(cache_folder):
+        if file.endswith('.json'):
+            cache_path = os.path.join(cache_folder, file)
+            if load_stac_cache(cache_path, ttl) is None:
+                num_removed += 1
+
+    return num_removed
+
+
+def _get_feat_date(feature: dict) -> str:
+    """
+    Date of a STAC feature (YYYY-MM-DD), empty if missing.
+    :param feature: Dictionary representing STAC metadata.
+    :return: String representing feature date.
+    """
+
+    return (feature.get('properties') or {}).get('datetime', '')[:10]
+
+
 def fetch_all_stac_feats(
         collections: list[str],
         start_date: str,
         end_date: str,
         bbox: tuple[float, float, float, float],
-        limit: int
+        limit: int,
+        max_threads: int = MAX_THREADS,
+        slice_days: int = SLICE_DAYS,
+        cache_folder: str = None,
+        cache_ttl: float = STAC_CACHE_TTL
 ) -> list[dict]:
     """
-    Iterates through provided DEA collections and queries DEA STAC endpoint
-    for features existing for each. Once all collections are obtained, all
-    results are merged and a list of STAC metadata dictionaries are merged.
+    Queries DEA STAC endpoint for features existing for each provided DEA
+    collection. Each collection's date range is split into sub-ranges and
+    all collections and sub-ranges are queried concurrently over one pooled
+    keep-alive session. Results are merged in order of collection, then
+    date, then page, as if queried one after another, and any feature
+    returned by two adjacent sub-ranges (see split_date_range) is kept once.
+    If a cache folder is given, each collection's result is cached on disk
+    per bbox and start date. Later queries ending before a cached end date
+    are served from disk, others only request the dates from the cached end
+    date on (its features are refreshed, as the last date may have been
+    partly indexed). Cached results expire cache_ttl seconds after they were
+    first queried in full.
     :param collections: List of strings representing DEA STAC collection names.
     :param start_date: String representing query start date (YYYY-MM-DD).
     :param end_date: String representing query end date (YYYY-MM-DD).
     :param bbox: Tuple of coordinates representing query bbox.
     :param limit: Integer representing max features to return per query.
+    :param max_threads: Integer representing max concurrent queries.
+    :param slice_days: Integer representing max days per sub-range query.
+    :param cache_folder: String representing STAC cache folder. Defaults to
+    None, in which case nothing is cached.
+    :param cache_ttl: Float representing max age of a cached result in seconds.
     :return: List of dictionaries representing all returned STAC metadata merged.
     """
 
-    all_features = []
+    # per collection, cached features still valid and urls of dates to query
+    plans = []
     for collection in collections:
         #arcpy.AddMessage(f'Querying STAC endpoint for {collection} data.')
         print(f'Querying STAC endpoint for {collection} data.')
 
-        stac_url = build_stac_query_url(collection,
-                                        start_date,
-                                        end_date,
-                                        bbox,
-                                        limit)
+        cache_path, entry, cached = None, None, []
+        query_start = start_date
+
+        if cache_folder is not None:
+            cache_path = _stac_cache_path(cache_folder, collection, bbox, start_date)
+            entry = load_stac_cache(cache_path, cache_ttl)
+
+        if entry is not None:
+            if entry['end_date'] > end_date:
+                cached = [f for f in entry['features'] if _get_feat_date(f) <= end_date]
+                query_start = None
+            else:
+                cached = [f for f in entry['features'] if _get_feat_date(f) < entry['end_date']]
+                query_start = entry['end_date']
+
+        stac_urls = []
+        if query_start is not None:
+            for sub_start, sub_end in split_date_range(query_start, end_date, slice_days):
+                stac_url = build_stac_query_url(collection,
+                                                sub_start,
+                                                sub_end,
+                                                bbox,
+                                                limit)
+                stac_urls.append(stac_url)
+
+        plans.append((collection, cache_path, entry, cached, stac_urls))
+
+    results = []
+    num_urls = sum(len(plan[-1]) for plan in plans)
+    if num_urls > 0:
+        with make_stac_session(max_threads) as session:
+            with ThreadPoolExecutor(max_workers=min(max_threads, num_urls)) as pool:
+                futures = [pool.submit(query_stac_endpoint, stac_url, session)
+                           for plan in plans for stac_url in plan[-1]]
+
+                # in submission order, raises the first failed query
+                results = [future.result() for future in futures]
+
+    results = iter(results)
 
-        new_features = query_stac_endpoint(stac_url)
-
-        if len(new_features) > 0:
-            all_features += new_features
+    all_features = []
+    for collection, cache_path, entry, cached, stac_urls in plans:
+        ids = set()
+        new_features = []
+        for features in [cached] + [next(results) for _ in stac_urls]:
+            for feature in features:
+                feature_id = feature.get('id')
+
+                if feature_id is None or feature_id not in ids:
+                    new_features.append(feature)
+                    ids.add(feature_id)
+
+        # only new queries change the cache, the full query time sets its expiry
+        if cache_path is not None and len(stac_urls) > 0:
+            save_stac_cache(cache_path, {
+                'collection': collection,
+                'bbox': list(bbox),
+                'start_date': start_date,
+                'created': entry['created'] if entry is not None else time.time(),
+                'end_date': end_date,
+                'features': new_features
+            })
+
+        all_features += new_features
 
     return all_features
 
@@ -701,7 +701,7 @@ class NewSite(QObject):
         self.set_is_processing(True)
 
         try:
-            ds = downloader.download_new_site_cube(
+            ds_cube = downloader.download_new_site_cube(
                 in_poly=coordinates,
                 out_nc=out_nc,
                 stac_cb_fn=stac_cb_fn,
@@ -710,10 +710,13 @@ class NewSite(QObject):
                 text_cb_fn=text_cb_fn
             )
 
-            # TODO: figure out how to implement this better
-            ds['ndvi'] = ((ds['nir_1'] - ds['red']) / (ds['nir_1'] + ds['red']))
-            ds = ds[['ndvi']].median(['x', 'y'])
-            ds = ds * 10000  # FIXME: decimal values not working when rounding=False, need to * 10000
+            # cube is read lazily from out_nc, close it once the median is in memory
+            try:
+                # TODO: figure out how to implement this better
+                ds_cube['ndvi'] = ((ds_cube['nir_1'] - ds_cube['red']) / (ds_cube['nir_1'] + ds_cube['red']))
+                ds = ds_cube[['ndvi']].median(['x', 'y']).load()  # only the median series is read into memory
+            finally:
+                ds_cube.close()
 
             ds_tmp = ds.copy(deep=True)
             self.set_xr_dataset(ds_tmp)
@@ -755,18 +758,29 @@ class NewSite(QObject):
         return
 
     def _refreshEwmacd(self):
-        dates, y_raw, y_hrm, y_res = algos.ewmacd(self._xr_dataset,
-                                                  self._train_start,
-                                                  self._train_end,
-                                                  self._test_end,
-                                                  self._num_harmonics,
-                                                  self._xbar_limit_1,
-                                                  self._xbar_limit_2,
-                                                  self._low_thresh,
-                                                  self._lambda_value,
-                                                  self._lambda_stdvs,
-                                                  self._rounding,
-                                                  self._persistence)
+        scale = 10000  # ndvi scaled in the engine, see ewmacd
+
+        ds = algos.ewmacd(self._xr_dataset,
+                          self._train_start,
+                          self._train_end,
+                          self._test_end,
+                          self._num_harmonics,
+                          self._xbar_limit_1,
+                          self._xbar_limit_2,
+                          self._low_thresh,
+                          self._lambda_value,
+                          self._lambda_stdvs,
+                          self._rounding,
+                          self._persistence,
+                          scale=scale)
+
+        # chart series and json export work on lists, fit for present dates only. ndvi and
+        # fit stay in engine units (x scale) as saved sites and charts have always been
+        is_present = ds['ndvi'].notnull().values
+        dates = pd.DatetimeIndex(ds['time'].values[is_present]).normalize().to_pydatetime().tolist()
+        y_raw = (ds['ndvi'].values[is_present].astype(float) * scale).tolist()
+        y_hrm = (ds['harm'].values[is_present].astype(float) * scale).tolist()
+        y_res = ds['chng'].values.tolist()
 
         self.set_algo_xs_date(dates)
         self.set_algo_ys_vege(y_raw)